@@ -0,0 +1,43 @@
+import sqlalchemy as sa
+
+
+def column_stats(connection, schemas):
+    """
+    Planner statistics for the tables of ``schemas`` from
+    ``information_schema``
+
+    Returns ``{(schema, table): {'width': bytes, 'distinct': {column: n}}}``,
+    where ``width`` is the average row length and ``n`` is the cardinality of
+    the indexes led by ``column``.  The default schema is reported as
+    ``None``, as ``Db.tables`` keys it.
+    """
+
+    default_schema = connection.execute('SELECT DATABASE()').scalar()
+    names = [schema or default_schema for schema in schemas]
+
+    def key(schema, table):
+        if schema == default_schema and None in schemas:
+            schema = None
+        return (schema, table)
+
+    stats = {}
+    qry = sa.text("""SELECT table_schema, table_name, avg_row_length
+                     FROM information_schema.tables
+                     WHERE table_schema IN :schemas""").bindparams(
+        sa.bindparam('schemas', expanding=True))
+    for (schema, table, width) in connection.execute(qry, schemas=names):
+        stats[key(schema, table)] = {'width': width, 'distinct': {}}
+    qry = sa.text("""SELECT table_schema, table_name, column_name,
+                            MAX(cardinality)
+                     FROM information_schema.statistics
+                     WHERE seq_in_index = 1 AND table_schema IN :schemas
+                     GROUP BY table_schema, table_name, column_name""").bindparams(
+        sa.bindparam('schemas', expanding=True))
+    for (schema, table, column, n_distinct) in connection.execute(
+            qry, schemas=names):
+        table_stats = stats.setdefault(key(schema, table), {
+            'width': None,
+            'distinct': {}
+        })
+        table_stats['distinct'][column] = n_distinct
+    return stats
@@ -1,4 +1,6 @@
+import json
 import re
+from collections import OrderedDict
 
 import sqlalchemy as sa
 from sqlalchemy import cast
@@ -57,3 +59,233 @@ def fix_postgres_array_of_enum(connection, tbl):
                     pass  # Must not have been an enum
                 else:
                     raise
+
+
+def column_stats(connection, schemas):
+    """
+    Planner statistics for the tables of ``schemas`` from ``pg_stats``
+
+    Returns ``{(schema, table): {'width': bytes, 'distinct': {column: n}}}``,
+    where ``width`` is the average row width and a negative ``n`` is a
+    fraction of the row count, as in ``pg_stats.n_distinct``.  The default
+    schema is reported as ``None``, as ``Db.tables`` keys it.
+    """
+
+    default_schema = connection.execute('SELECT current_schema()').scalar()
+    names = [schema or default_schema for schema in schemas]
+    qry = sa.text("""SELECT schemaname, tablename, attname,
+                            n_distinct, avg_width
+                     FROM pg_stats WHERE schemaname = ANY(:schemas)""")
+    stats = {}
+    for (schema, table, column, n_distinct, avg_width) in connection.execute(
+            qry, schemas=names):
+        if schema == default_schema and None in schemas:
+            schema = None
+        table_stats = stats.setdefault((schema, table), {
+            'width': 0,
+            'distinct': {}
+        })
+        table_stats['width'] += avg_width or 0
+        table_stats['distinct'][column] = n_distinct
+    return stats
+
+
+CATALOG_TABLES = """
+    SELECT c.oid FROM pg_catalog.pg_class c
+    JOIN pg_catalog.pg_namespace n ON n.oid = c.relnamespace
+    WHERE c.relkind IN ('r', 'p') AND n.nspname = ANY(:schemas)"""
+
+
+def reflect_catalog(connection, schemas):
+    """
+    Tables, columns, keys, indexes and row estimates for ``schemas``, read
+    in a few bulk ``pg_catalog`` queries rather than several per table
+
+    Returns ``{(schema, table): {'columns': [...], 'pk': [...], 'fks': [...],
+    'indexes': [...], 'reltuples': n}}``, with columns and foreign keys
+    described as ``Inspector`` describes them.  The default schema is reported
+    as ``None``, as ``Db.tables`` keys it.  Foreign keys to tables outside
+    ``schemas`` are left out.
+
+    Columns are described by the PostgreSQL dialect's private
+    ``_get_column_info``, whose signature changes between SQLAlchemy
+    releases; ``Db`` falls back to the ``Inspector`` if this fails.
+    """
+
+    dialect = connection.dialect
+    default_schema = connection.execute('SELECT current_schema()').scalar()
+    names = [schema or default_schema for schema in schemas]
+
+    def key(schema, table):
+        if schema == default_schema and None in schemas:
+            schema = None
+        return (schema, table)
+
+    catalog = {}
+    by_oid = {}
+    qry = sa.text("""SELECT c.oid, n.nspname, c.relname, c.reltuples
+                     FROM pg_catalog.pg_class c
+                     JOIN pg_catalog.pg_namespace n
+                       ON n.oid = c.relnamespace
+                     WHERE c.oid IN (%s)""" % CATALOG_TABLES)
+    for (oid, schema, table, reltuples) in connection.execute(qry,
+                                                              schemas=names):
+        by_oid[oid] = catalog[key(schema, table)] = {
+            'schema': key(schema, table)[0],
+            'columns': [],
+            'pk': [],
+            'fks': [],
+            'indexes': [],
+            'reltuples': reltuples,
+        }
+
+    domains = dialect._load_domains(connection)
+    enums = dict(((rec['name'], ), rec) if rec['visible'] else (
+        (rec['schema'], rec['name']), rec)
+                 for rec in dialect._load_enums(connection, schema='*'))
+    generated = ('a.attgenerated' if dialect.server_version_info >= (12, )
+                 else 'NULL')
+    qry = sa.text("""SELECT a.attrelid, a.attname,
+                            pg_catalog.format_type(a.atttypid, a.atttypmod),
+                            pg_catalog.pg_get_expr(d.adbin, d.adrelid),
+                            a.attnotnull, %s
+                     FROM pg_catalog.pg_attribute a
+                     LEFT JOIN pg_catalog.pg_attrdef d
+                       ON d.adrelid = a.attrelid AND d.adnum = a.attnum
+                      AND a.atthasdef
+                     WHERE a.attrelid IN (%s)
+                       AND a.attnum > 0 AND NOT a.attisdropped
+                     ORDER BY a.attrelid, a.attnum""" %
+                  (generated, CATALOG_TABLES))
+    for (oid, name, format_type, default, notnull,
+         attgenerated) in connection.execute(qry, schemas=names):
+        entry = by_oid[oid]
+        entry['columns'].append(
+            dialect._get_column_info(name, format_type, default, notnull,
+                                     domains, enums, entry['schema'], None,
+                                     attgenerated))
+
+    qry = sa.text("""SELECT con.conrelid, a.attname
+                     FROM pg_catalog.pg_constraint con
+                     CROSS JOIN LATERAL unnest(con.conkey)
+                       WITH ORDINALITY AS k(attnum, position)
+                     JOIN pg_catalog.pg_attribute a
+                       ON a.attrelid = con.conrelid AND a.attnum = k.attnum
+                     WHERE con.contype = 'p' AND con.conrelid IN (%s)
+                     ORDER BY con.conrelid, k.position""" % CATALOG_TABLES)
+    for (oid, column) in connection.execute(qry, schemas=names):
+        by_oid[oid]['pk'].append(column)
+
+    qry = sa.text("""SELECT con.conrelid, con.conname, rn.nspname, rc.relname,
+                            ca.attname, ra.attname
+                     FROM pg_catalog.pg_constraint con
+                     CROSS JOIN LATERAL unnest(con.conkey, con.confkey)
+                       WITH ORDINALITY AS k(conattnum, refattnum, position)
+                     JOIN pg_catalog.pg_attribute ca
+                       ON ca.attrelid = con.conrelid
+                      AND ca.attnum = k.conattnum
+                     JOIN pg_catalog.pg_attribute ra
+                       ON ra.attrelid = con.confrelid
+                      AND ra.attnum = k.refattnum
+                     JOIN pg_catalog.pg_class rc ON rc.oid = con.confrelid
+                     JOIN pg_catalog.pg_namespace rn
+                       ON rn.oid = rc.relnamespace
+                     WHERE con.contype = 'f' AND con.conrelid IN (%s)
+                     ORDER BY con.conrelid, con.conname, k.position""" %
+                  CATALOG_TABLES)
+    fks = OrderedDict()
+    for (oid, name, referred_schema, referred_table, column,
+         referred_column) in connection.execute(qry, schemas=names):
+        fk = fks.setdefault((oid, name), {
+            'name': name,
+            'constrained_columns': [],
+            'referred_schema': key(referred_schema, referred_table)[0],
+            'referred_table': referred_table,
+            'referred_columns': [],
+            'options': {},
+        })
+        fk['constrained_columns'].append(column)
+        fk['referred_columns'].append(referred_column)
+    for ((oid, name), fk) in fks.items():
+        if (fk['referred_schema'], fk['referred_table']) in catalog:
+            by_oid[oid]['fks'].append(fk)
+
+    qry = sa.text("""SELECT ix.indrelid, ix.indexrelid, a.attname
+                     FROM pg_catalog.pg_index ix
+                     CROSS JOIN LATERAL unnest(ix.indkey::smallint[])
+                       WITH ORDINALITY AS k(attnum, position)
+                     JOIN pg_catalog.pg_attribute a
+                       ON a.attrelid = ix.indrelid AND a.attnum = k.attnum
+                     WHERE NOT ix.indisprimary AND ix.indrelid IN (%s)
+                     ORDER BY ix.indrelid, ix.indexrelid, k.position""" %
+                  CATALOG_TABLES)
+    indexes = OrderedDict()
+    for (oid, index_oid, column) in connection.execute(qry, schemas=names):
+        indexes.setdefault((oid, index_oid), []).append(column)
+    for ((oid, index_oid), columns) in indexes.items():
+        by_oid[oid]['indexes'].append(columns)
+
+    return catalog
+
+
+def build_tables(meta, catalog, schema):
+    """
+    Add the tables of ``schema`` described by ``reflect_catalog`` to
+    ``meta``, as ``MetaData.reflect`` would; arrays of enums get
+    ``ArrayOfEnum`` directly, without probing each array column
+    """
+
+    tables = {}
+    for ((table_schema, name), entry) in catalog.items():
+        if table_schema != schema:
+            continue
+        columns = []
+        for info in entry['columns']:
+            col_type = info['type']
+            if isinstance(col_type, ARRAY) and isinstance(col_type.item_type,
+                                                          ENUM):
+                col_type = ArrayOfEnum(col_type.item_type)
+            args = []
+            if info.get('computed'):
+                args.append(
+                    sa.Computed(info['computed']['sqltext'],
+                                persisted=info['computed']['persisted']))
+            server_default = None
+            if info['default'] is not None:
+                server_default = sa.text(info['default'])
+            columns.append(
+                sa.Column(info['name'],
+                          col_type,
+                          *args,
+                          nullable=info['nullable'],
+                          server_default=server_default,
+                          autoincrement=info['autoincrement']))
+        if entry['pk']:
+            columns.append(sa.PrimaryKeyConstraint(*entry['pk']))
+        tables[(table_schema, name)] = sa.Table(name,
+                                                meta,
+                                                *columns,
+                                                schema=schema)
+    for (key, tbl) in tables.items():
+        for fk in catalog[key]['fks']:
+            referred = (fk['referred_schema'], fk['referred_table'])
+            if referred not in tables:
+                continue
+            tbl.append_constraint(
+                sa.ForeignKeyConstraint(
+                    fk['constrained_columns'],
+                    [tables[referred].c[column]
+                     for column in fk['referred_columns']],
+                    name=fk['name']))
+    return tables
+
+
+def estimate_rows(connection, qry):
+    "The planner's estimate of the number of rows ``qry`` returns"
+
+    sql = str(qry.compile(dialect=connection.dialect,
+                          compile_kwargs={'literal_binds': True}))
+    plan = connection.execute('EXPLAIN (FORMAT JSON) ' + sql).scalar()
+    if isinstance(plan, str):
+        plan = json.loads(plan)
+    return plan[0]['Plan']['Plan Rows']
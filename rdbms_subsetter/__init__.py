@@ -0,0 +1 @@
+from rdbms_subsetter.subsetter import Subsetter  # noqa: F401
@@ -0,0 +1,241 @@
+"""
+Estimates of how large a subset will grow, made before any rows are copied.
+
+Every sampled row pulls in its parent rows, and requests up to
+``--children`` of its child rows, which pull in more parents and children in
+turn; so the rows finally created can far exceed each table's target (though
+the main loop stops taking a table's requested rows once its completeness
+score is high enough).  ``estimate`` follows the foreign key graph using row
+counts and, where the database keeps them, column statistics (``pg_stats`` on
+PostgreSQL, ``information_schema`` on MySQL) to predict the rows, bytes and
+queries for each table.
+"""
+import logging
+import math
+from collections import OrderedDict
+
+from dialects import mysql, postgres
+
+# Bytes assumed per column when the database keeps no row width statistics
+DEFAULT_COLUMN_WIDTH = 16
+
+# Passes over the foreign key graph; each one follows one more generation
+# of parents and children
+ROUNDS = 20
+
+SIZE_UNITS = ('B', 'KB', 'MB', 'GB', 'TB')
+
+# The completeness score past which the main loop is done with a table, and
+# the exponent it gives the share of desired rows (see
+# ``subsetter._completeness_score``)
+COMPLETE = 0.97
+COMPLETENESS_EXPONENT = 0.33
+
+
+def column_stats(db):
+    """Row width and distinct value statistics for the tables of ``db``,
+    as returned by the dialect's ``column_stats``; empty where unknown"""
+    dialect_stats = {
+        'postgresql': postgres.column_stats,
+        'mysql': mysql.column_stats,
+    }.get(db.engine.dialect.name)
+    if not dialect_stats:
+        return {}
+    try:
+        return dialect_stats(db.conn, db.schemas)
+    except Exception as e:
+        logging.debug("failed to get column statistics\n%s" % str(e))
+        return {}
+
+
+def _width(tbl, stats):
+    width = stats.get((tbl.schema, tbl.name), {}).get('width')
+    return width or DEFAULT_COLUMN_WIDTH * len(tbl.c)
+
+
+def _children_per_parent(lookup, parent, stats):
+    """Average number of child rows referring to each parent row"""
+    child = lookup['table']
+    distinct = stats.get((child.schema, child.name), {}).get(
+        'distinct', {}).get(lookup['constrained_columns'][0])
+    if distinct is not None and distinct < 0:  # a fraction of the rows
+        distinct = -distinct * child.n_rows
+    if not distinct:
+        distinct = min(child.n_rows, parent.n_rows)
+    return child.n_rows / float(distinct or 1)
+
+
+def _children_taken(per_parent, children):
+    """Expected child rows taken for each parent, at most ``children`` of
+    them, when parents have ``per_parent`` children on average (taken to be
+    Poisson distributed, so many parents have none)"""
+    taken = 0.0
+    (p_k, p_at_most_k) = (math.exp(-per_parent), 0.0)
+    for k in range(children):
+        p_at_most_k += p_k
+        taken += 1 - p_at_most_k  # chance of a (k + 1)th child
+        p_k *= per_parent / (k + 1)
+    return taken
+
+
+def _distinct_drawn(n_rows, draws):
+    """Expected number of distinct rows among ``draws`` random picks of
+    ``n_rows`` rows"""
+    if not n_rows:
+        return 0.0
+    return n_rows * (1 - math.pow(1 - 1.0 / n_rows, draws))
+
+
+def _processed(desired, requested, n_rows):
+    """
+    Rows of a table created by the main loop, which takes its ``requested``
+    rows first (and then random ones), until the table's completeness score
+    passes ``COMPLETE``
+
+    The score is the share of ``desired`` rows created (to the power
+    ``COMPLETENESS_EXPONENT``) less the rows still requested per row
+    created (requests for rows already created are dropped), so requests
+    far beyond ``desired`` are left unprocessed.
+    """
+    if not desired:
+        return 0.0
+
+    def score(created):
+        return (math.pow(created / float(desired), COMPLETENESS_EXPONENT) -
+                max(requested - created, 0) * (1 - created / float(n_rows)) /
+                created)
+
+    (low, high) = (0.0, float(min(n_rows, desired + requested)))
+    if not high or score(high) <= COMPLETE:
+        return high
+    for _ in range(32):
+        middle = (low + high) / 2
+        if middle and score(middle) > COMPLETE:
+            high = middle
+        else:
+            low = middle
+    return high
+
+
+def estimate(db, desired, children, stats):
+    """
+    Predict the subset's size for each table of the source ``db``
+
+    ``desired`` maps each table key to its target row count.  Returns an
+    ordered ``{key: {'rows': n, 'bytes': n, 'queries': n}}``.
+    """
+    rows = dict(desired)
+    for _ in range(ROUNDS):
+        requested = dict((key, 0.0) for key in desired)
+        # rows requested as children, by child table and foreign key
+        requested_by = {}
+        for (key, tbl) in db.tables.items():
+            if not rows[key]:
+                continue
+            for lookup in tbl.target.child_lookups:
+                child = lookup['table']
+                if child.target.fetch_all:
+                    continue
+                per_parent = _children_taken(
+                    _children_per_parent(lookup, tbl, stats), children)
+                child_key = (child.schema, child.name)
+                requested[child_key] += rows[key] * per_parent
+                requested_by[(child_key, tuple(
+                    lookup['constrained_columns']))] = rows[key] * per_parent
+        processed = dict(
+            (key, desired[key] if tbl.target.fetch_all else _processed(
+                desired[key], requested[key], tbl.n_rows))
+            for (key, tbl) in db.tables.items())
+        grown = dict(processed)
+        for (key, tbl) in reversed(list(db.tables.items())):  # children first
+            for lookup in tbl.target.parent_lookups:
+                parent = lookup['table'].source
+                parent_key = (parent.schema, parent.name)
+                if parent.target.fetch_all:
+                    continue
+                if parent is tbl:
+                    continue  # mostly rows it has, as it takes children too
+                # rows wanted anyway, plus those this table's rows require
+                # (but rows taken as children of parents have them already)
+                via = requested_by.get(
+                    (key, tuple(lookup['constrained_columns'])), 0)
+                needed = _distinct_drawn(
+                    parent.n_rows, grown[key] - min(
+                        processed[key], requested[key]) * via /
+                    (requested[key] or 1))
+                wanted = grown[parent_key]
+                grown[parent_key] = parent.n_rows * (1 - (
+                    1 - wanted / float(parent.n_rows or 1)) * (
+                        1 - needed / float(parent.n_rows or 1)))
+        for (key, tbl) in db.tables.items():
+            grown[key] = min(grown[key], tbl.n_rows)
+        converged = all(abs(grown[key] - rows[key]) < 1 for key in rows)
+        rows = grown
+        if converged:
+            break
+
+    plan = OrderedDict()
+    for (key, tbl) in db.tables.items():
+        n_rows = rows[key]
+        target = tbl.target
+        if target.fetch_all:
+            queries = 2 * math.ceil(n_rows / float(db.args.buffer or 1000))
+        else:
+            per_row = 2 * len(target.parent_lookups) + sum(
+                1 for lookup in target.child_lookups if not lookup['batched'])
+            scans = sum(
+                math.ceil(n_rows / float(db.args.child_scan_batch))
+                for lookup in target.child_lookups if lookup['batched'])
+            inserts = math.ceil(n_rows / float(db.args.buffer or 1))
+            queries = n_rows * per_row + scans + inserts
+        plan[key] = {
+            'rows': int(math.ceil(n_rows)),
+            'bytes': int(n_rows * _width(tbl, stats)),
+            'queries': int(queries),
+        }
+    return plan
+
+
+def total(plan, measure):
+    return sum(table[measure] for table in plan.values())
+
+
+def suggest(db, desired_for, fraction, children, budget, stats):
+    """
+    ``(children, fraction, bytes)`` choices whose estimated size stays
+    within ``budget`` bytes: for each ``--children`` value from ``children``
+    down to 0, the largest fraction that fits (found by bisection)
+    """
+    suggestions = []
+    candidates = sorted(set([children, children // 2, 1, 0]), reverse=True)
+    for n_children in candidates:
+        if n_children > children:
+            continue
+        (low, high) = (0.0, fraction)
+        for _ in range(16):
+            middle = (low + high) / 2
+            plan = estimate(db, desired_for(middle), n_children, stats)
+            if total(plan, 'bytes') <= budget:
+                low = middle
+            else:
+                high = middle
+        if low > 0:
+            plan = estimate(db, desired_for(low), n_children, stats)
+            suggestions.append((n_children, low, total(plan, 'bytes')))
+    return suggestions
+
+
+def human_size(n_bytes):
+    for unit in SIZE_UNITS:
+        if n_bytes < 1024 or unit == SIZE_UNITS[-1]:
+            return "%.1f %s" % (n_bytes, unit)
+        n_bytes /= 1024.0
+
+
+def size(raw):
+    """Parse a size like ``500MB`` or ``2 GB`` into bytes"""
+    raw = raw.strip().upper()
+    for (power, unit) in reversed(list(enumerate(SIZE_UNITS))):
+        if raw.endswith(unit):
+            return int(float(raw[:-len(unit)]) * math.pow(1024, power))
+    return int(raw)
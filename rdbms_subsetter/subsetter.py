@@ -59,35 +59,76 @@ Case-specific table names will probably create bad results in rdbms-subsetter,
 and in the rest of your life, for that matter.  Don't do it.
 """
 import argparse
+import csv
 import fnmatch
 import functools
+import itertools
 import json
 import logging
 import math
+import os
 import random
+import time
 import types
+import zlib
 from collections import OrderedDict, deque
 
 import sqlalchemy as sa
 from blinker import signal
+from sqlalchemy.dialects import mysql, postgresql
 from sqlalchemy.engine.reflection import Inspector
 
-from dialects.postgres import fix_postgres_array_of_enum
-
-# Python2 has a totally different definition for ``input``; overriding it here
-try:
-    input = raw_input
-except NameError:
-    pass
+from dialects.postgres import (build_tables, estimate_rows,
+                               fix_postgres_array_of_enum, reflect_catalog)
+from rdbms_subsetter import planner
 
 __version__ = '0.2.6.2'
 
 SIGNAL_ROW_ADDED = 'row_added'
+SIGNAL_ROWS_FLUSHED = 'rows_flushed'
+
+# Each ``Db`` keeps one dedicated connection per role, so that a streaming
+# sample cursor never has to share its connection with lookups or inserts.
+# ``Db.conn`` remains the connection for reflection and catalog queries.
+CONNECTION_ROLES = ('sample', 'lookup', 'fetch', 'write')
+
+# Roles whose work - sampling, child lookups and bulk row fetches - is
+# spread over the source's read replicas (``--replica``), when it has any
+REPLICA_ROLES = ('sample', 'fetch')
+
+COMPILED_CACHE_SIZE = 500
+
+# ``--seed`` sampling places each row in one of this many buckets by a hash
+# of its key, and takes rows bucket by bucket
+HASH_BUCKETS = 10000
+
+# SQLite virtual machine steps between checks of a statement's ``--timeout``
+SQLITE_PROGRESS_STEPS = 1000
+
+# Dialects whose queries ``--timeout`` can cancel (see ``Db.guarded_fetch``)
+TIMEOUT_DIALECTS = ('postgresql', 'mysql', 'sqlite')
+
+# Number of keys looked up per ``IN`` query
+KEY_BATCH_SIZE = 500
 
 
 def _find_n_rows(self, estimate=False):
     self.n_rows = 0
-    if estimate:
+    if self.sample_filter is not None:
+        if estimate and self.db.engine.dialect.name == 'postgresql':
+            try:
+                self.n_rows = estimate_rows(self.db.conn, self.sample_query())
+            except Exception as e:
+                logging.debug("failed to estimate filtered rows of %s\n%s" %
+                              (self.name, str(e)))
+        if not self.n_rows:
+            self.n_rows = self.db.conn.execute(
+                self.sample_query([sa.func.count()]).select_from(
+                    self)).scalar()
+        return
+    if estimate and self.n_rows_estimate and self.n_rows_estimate > 0:
+        self.n_rows = self.n_rows_estimate
+    elif estimate:
         try:
             if self.db.engine.driver in ('psycopg2', 'pg8000', ):
                 schema = (self.schema + '.') if self.schema else ''
@@ -109,6 +150,15 @@ def _find_n_rows(self, estimate=False):
         self.n_rows = self.db.conn.execute(self.count()).fetchone()[0]
 
 
+def _sample_query(self, columns=None):
+    """SELECT the table's ``projection`` (or ``columns``) from the rows that
+    the ``filters`` config allows to be sampled"""
+    qry = sa.sql.select(self.projection if columns is None else columns)
+    if self.sample_filter is not None:
+        qry = qry.where(self.sample_filter)
+    return qry
+
+
 def _random_row_func(self):
     dialect = self.bind.engine.dialect.name
     if 'mysql' in dialect or 'mssql' in dialect:
@@ -128,35 +178,279 @@ def _random_row_gen_fn(self):
             n = self.target.n_rows_desired
             if self.n_rows > 1000:
                 fraction = n / float(self.n_rows)
-                qry = sa.sql.select([self, ]).where(self.random_row_func() <
-                                                    fraction)
-                results = self.db.conn.execute(qry).fetchall()
+                qry = self.sample_query().where(
+                    self.random_row_func() < fraction)
+                results = self.db.guarded_fetch('sample', qry)
                 # we may stop wanting rows at any point, so shuffle them so as not to
                 # skew the sample toward those near the beginning
                 random.shuffle(results)
                 for row in results:
                     yield row
             else:
-                qry = sa.sql.select([self, ]).order_by(self.random_row_func(
-                )).limit(n)
-                for row in self.db.conn.execute(qry):
+                qry = self.sample_query().order_by(
+                    self.random_row_func()).limit(n)
+                for row in self.db.guarded_fetch('sample', qry):
                     yield row
 
 
-def _next_row(self):
-    if self.target.required:
-        return self.target.required.popleft()
-    elif self.target.requested:
-        return self.target.requested.popleft()
+def _tablesample_row_gen_fn(self):
+    """
+    Sample of blocks of the table (PostgreSQL's ``TABLESAMPLE SYSTEM``),
+    which reads only the blocks it returns
+    """
+    if self.n_rows:
+        percent = min(100.0, 100.0 * self.target.n_rows_desired / self.n_rows)
+        rng = _sample_rng(self)
+        while True:
+            sample = sa.tablesample(self, sa.func.system(percent))
+            results = self.db.guarded_fetch(
+                'sample', self.sample_query(_projection(self, sample.c)))
+            if not results:  # no rows in the blocks drawn; draw more
+                percent = min(100.0, percent * 2)
+            rng.shuffle(results)
+            for row in results:
+                yield row
+
+
+def _sample_rng(self):
+    """Random source for sampling strategies: fixed for each table by
+    ``--seed``, if given"""
+    if self.db.args.seed is None:
+        return random.Random()
+    return random.Random('%s:%s' % (self.db.args.seed,
+                                    _qualified_name(self.schema, self.name)))
+
+
+def _seeded_order(self):
+    """Columns to order queries of this table by, so that which rows they
+    return doesn't vary between ``--seed`` runs: its key, when seeded"""
+    if self.db.args.seed is None:
+        return []
+    return [self.c[col] for col in self.pk]
+
+
+def _keyset_row_gen_fn(self):
+    """
+    Runs of rows in order of the first key column, from a random starting
+    point (for numeric keys) onward; each query reads only the index range
+    it returns
+    """
+    if self.n_rows:
+        n = self.target.n_rows_desired
+        col = self.c[self.pk[0]]
+        ((lowest, highest), ) = self.db.guarded_fetch(
+            'sample', self.sample_query([sa.func.min(col), sa.func.max(col)]))
+        if lowest is None:
+            return
+        start = lowest
+        rng = _sample_rng(self)
+        if isinstance(lowest, (int, float)) and not isinstance(lowest, bool):
+            start = type(lowest)(lowest + (highest - lowest) * rng.random())
+        (inclusive, wrapped) = (True, False)
+        while True:
+            qry = self.sample_query().where(
+                col >= start if inclusive else col > start).order_by(
+                    col).limit(n)
+            results = self.db.guarded_fetch('sample', qry)
+            if not results:  # past the highest key; start over
+                if wrapped:
+                    return
+                (start, inclusive, wrapped) = (lowest, True, True)
+                continue
+            (start, inclusive, wrapped) = (results[-1][col.name], False,
+                                           False)
+            rng.shuffle(results)
+            for row in results:
+                yield row
+
+
+def _scan_row_gen_fn(self):
+    """
+    Successive runs of rows in the configured ``order_by`` order, or else in
+    whatever order the table is stored, the cheapest query there is (by key,
+    with ``--seed``)
+    """
+    if self.n_rows:
+        n = self.target.n_rows_desired
+        offset = 0
+        while True:
+            qry = self.sample_query()
+            if self.sample_order is not None:
+                qry = qry.order_by(self.sample_order)
+            else:
+                qry = qry.order_by(*_seeded_order(self))
+            qry = qry.limit(n).offset(offset)
+            results = self.db.guarded_fetch('sample', qry)
+            if not results:
+                if not offset:
+                    return
+                offset = 0
+                continue
+            offset += len(results)
+            for row in results:
+                yield row
+
+
+def _hash_bucket(self, seed):
+    """
+    SQL expression for the bucket (0 to ``HASH_BUCKETS - 1``) of each row,
+    from a hash of its key and ``seed``.  An expression index on it lets the
+    database find a bucket's rows without scanning the table.
+    """
+    key = sa.literal(str(seed))
+    for col in self.pk:
+        key = key + '|' + sa.func.coalesce(sa.cast(self.c[col], sa.String), '')
+    dialect = self.bind.engine.dialect.name
+    if dialect == 'postgresql':
+        hashed = sa.func.abs(sa.cast(sa.func.hashtext(key), sa.BigInteger))
+    elif 'mysql' in dialect:
+        hashed = sa.func.crc32(key)
+    elif 'oracle' in dialect:
+        return sa.func.ora_hash(key, HASH_BUCKETS - 1)
+    elif 'mssql' in dialect:
+        hashed = sa.func.abs(sa.cast(sa.func.checksum(key), sa.BigInteger))
+    elif dialect == 'sqlite':
+        hashed = sa.func.subsetter_hash(key)
+    else:
+        raise NotImplementedError("No hash function known for dialect %s" %
+                                  dialect)
+    return hashed % HASH_BUCKETS
+
+
+def _hashed_row_gen_fn(self):
+    """
+    Reproducible sample of *approximate* size n, chosen by hash bucket
+
+    Each pass takes the next slice of buckets, so that asking for more rows
+    than the first slice holds still turns up new ones.
+    """
+    if self.n_rows:
+        bucket = self.hash_bucket(self.db.args.seed)
+        n = self.target.n_rows_desired
+        width = max(1, int(math.ceil(HASH_BUCKETS * n / float(self.n_rows))))
+        lower = 0
+        while True:
+            upper = min(lower + width, HASH_BUCKETS)
+            qry = self.sample_query().where(bucket >= lower).where(
+                bucket < upper).order_by(bucket, *(self.c[col]
+                                                   for col in self.pk))
+            for row in self.hashed_rows(qry, lower, upper):
+                yield row
+            lower = upper % HASH_BUCKETS
+
+
+def _hashed_rows(self, qry, lower, upper):
+    """Rows of the buckets ``lower`` to ``upper``, by their keys recorded
+    in the ``--cache`` file when a previous run with this seed has them"""
+    if not self.db.args.cache or lower:
+        return self.db.guarded_fetch('sample', qry)
+    name = _qualified_name(self.schema, self.name)
+    samples = self.db.state.setdefault('samples', {})
+    sample = {'seed': self.db.args.seed, 'lower': lower, 'upper': upper}
+    cached = samples.get(name, {})
+    if all(cached.get(k) == v for (k, v) in sample.items()):
+        keys = [hashable(key) for key in cached['keys']]
+        rows = dict((hashable(row[col] for col in self.pk), row)
+                    for row in self.by_keys(self.pk, keys))
+        return [rows[key] for key in keys if key in rows]
+    rows = self.db.guarded_fetch('sample', qry)
+    sample['keys'] = [[row[col] for col in self.pk] for row in rows]
+    try:
+        json.dumps(sample)
+    except TypeError:
+        logging.debug("keys of %s can't be cached" % name)
+    else:
+        samples[name] = sample
+    return rows
+
+
+SAMPLE_STRATEGIES = OrderedDict((
+    ('random', _random_row_gen_fn),
+    ('tablesample', _tablesample_row_gen_fn),
+    ('hash', _hashed_row_gen_fn),
+    ('keyset', _keyset_row_gen_fn),
+    ('scan', _scan_row_gen_fn),
+))
+
+
+def _sample_strategies(self):
+    """Names of the sampling strategies to try for this table, in order"""
+    if self.sample_order is not None:  # the first rows in that order
+        return ['scan']
+    if self.db.args.seed is None:
+        strategies = ['random', 'keyset', 'scan']
+        if self.db.engine.dialect.name == 'postgresql':
+            strategies.insert(1, 'tablesample')
     else:
+        strategies = ['hash', 'keyset', 'scan']
+    recorded = self.db.state.get('strategies', {}).get('sample', {}).get(
+        _qualified_name(self.schema, self.name))
+    if recorded in strategies:
+        strategies = strategies[strategies.index(recorded):]
+    return strategies
+
+
+def _sampled_row_gen_fn(self):
+    """
+    Rows sampled by the first strategy whose queries finish within
+    ``--timeout``
+
+    When one times out, sampling goes on with the next, cheaper one, which
+    is recorded in the ``--cache`` file so that later runs start there.
+    """
+    strategies = _sample_strategies(self)
+    for (i, strategy) in enumerate(strategies):
         try:
-            return (next(self.random_rows), False)  # not prioritized
-        except StopIteration:
-            return None
+            for row in SAMPLE_STRATEGIES[strategy](self):
+                yield row
+            return
+        except sa.exc.DBAPIError as error:
+            if not _timed_out(error) or i == len(strategies) - 1:
+                raise
+            logging.warning("sampling %s by %s timed out; trying %s" %
+                            (self.name, strategy, strategies[i + 1]))
+            self.db.record_strategy('sample',
+                                    _qualified_name(self.schema, self.name),
+                                    strategies[i + 1])
+
+
+def _next_row(self):
+    """The next row to create in the target, and whether it's prioritized:
+    required rows first, then requested rows, then random ones"""
+    target = self.target
+    for (queue, fetched, prioritized) in (
+        (target.required, target.fetched_required, True),
+        (target.requested, target.fetched_requested, False),
+    ):
+        if queue and not fetched:
+            fetched.extend(self.fetch_queued(queue))
+            target.fetched_keys.update(
+                hashable(row[col] for col in self.pk) for row in fetched)
+        if fetched:
+            row = fetched.popleft()
+            target.fetched_keys.discard(hashable(row[col] for col in self.pk))
+            return (row, prioritized)
+    try:
+        return (next(self.random_rows), False)  # not prioritized
+    except StopIteration:
+        return None
+
+
+def _fetch_queued(self, queue):
+    """Rows for a batch of entries taken from the front of ``queue``: by
+    their keys, in batched queries, unless the table has no primary key
+    (then the queue holds the rows themselves)"""
+    batch = [queue.popitem(last=False)
+             for _ in range(min(KEY_BATCH_SIZE, len(queue)))]
+    if not self.primary_key.columns:
+        return [row for (_, row) in batch]
+    rows = dict((hashable(row[col] for col in self.pk), row)
+                for row in self.by_keys(self.pk, [key for (key, _) in batch]))
+    return [self.compact(rows[key]) for (key, _) in batch if key in rows]
 
 
 def _filtered_by(self, **kw):
-    slct = sa.sql.select([self, ])
+    slct = sa.sql.select(self.projection)
     slct = slct.where(sa.sql.and_((self.c[k] == v) for (k, v) in kw.items()))
     return slct
 
@@ -169,17 +463,37 @@ def _pk_val(self, row):
 
 
 def _by_pk(self, pk):
-    pk_name = self.db.inspector.get_primary_keys(self.name, self.schema)[0]
-    slct = self.filtered_by(**{pk_name: pk})
-    return self.db.conn.execute(slct).fetchone()
+    slct = self.filtered_by(**{self.pk[0]: pk})
+    return self.db.connection('lookup').execute(slct).fetchone()
+
+
+def _by_keys(self, columns, keys, selected=None):
+    """Rows (or just the ``selected`` columns) whose ``columns`` match any
+    of ``keys``, in batched IN queries"""
+    if selected is None:
+        selected = self.projection
+    cols = [self.c[col] for col in columns]
+    conn = self.db.connection('fetch')
+    for start in range(0, len(keys), KEY_BATCH_SIZE):
+        batch = keys[start:start + KEY_BATCH_SIZE]
+        if len(cols) == 1:
+            where = cols[0].in_([key[0] for key in batch])
+        elif 'mssql' in self.bind.engine.dialect.name:  # no row values
+            where = sa.sql.or_(*(sa.sql.and_(*(col == val
+                                              for (col, val) in zip(cols, key)))
+                                 for key in batch))
+        else:
+            where = sa.sql.tuple_(*cols).in_(batch)
+        for row in conn.execute(sa.sql.select(selected).where(where)):
+            yield row
 
 
 def _completeness_score(self):
     """Scores how close a target table is to being filled enough to quit"""
     table = (self.schema if self.schema else "") + self.name
     fetch_all = self.fetch_all
-    requested = len(self.requested)
-    required = len(self.required)
+    requested = len(self.requested) + len(self.fetched_requested)
+    required = len(self.required) + len(self.fetched_required)
     n_rows = float(self.n_rows)
     n_rows_desired = float(self.n_rows_desired)
     logging.debug("%s.fetch_all      = %s", table, fetch_all)
@@ -191,7 +505,7 @@ def _completeness_score(self):
         if n_rows < n_rows_desired:
             return 1 + (n_rows or 1) - (n_rows_desired or 1)
     result = 0 - (requested / (n_rows or 1)) - required
-    if not self.required:  # anything in `required` queue disqualifies
+    if not required:  # anything in `required` queue disqualifies
         result += (n_rows / (n_rows_desired or 1))**0.33
     return result
 
@@ -211,25 +525,423 @@ def _table_matches_any_pattern(schema, table, patterns):
                for each in patterns)
 
 
+def _key_lookup(table, columns, selected=None):
+    """SELECT rows (or just the ``selected`` columns) of ``table`` whose
+    ``columns`` equal the bind parameters ``key_0``, ``key_1``...; see
+    ``_key_params``"""
+    if selected is None:
+        selected = table.projection
+    return sa.sql.select(selected).where(sa.sql.and_(*(
+        table.c[col] == sa.bindparam('key_%d' % i)
+        for (i, col) in enumerate(columns))))
+
+
+def _key_params(row, columns):
+    return dict(('key_%d' % i, row[col]) for (i, col) in enumerate(columns))
+
+
+def _parent_lookup(fk, source_db, target_db, enforced):
+    """Statements for finding the parent row of ``fk`` in the target and
+    the source, built once so that only their parameters change per row"""
+    key = (fk['referred_schema'], fk['referred_table'])
+    return {
+        'table': target_db.tables[key],
+        'constrained_columns': fk['constrained_columns'],
+        'referred_columns': fk['referred_columns'],
+        # only whether the parent is in the target matters
+        'target_query': _key_lookup(target_db.tables[key],
+                                    fk['referred_columns'], [
+                                        target_db.tables[key].c[col]
+                                        for col in fk['referred_columns']
+                                    ]),
+        'source_query': _key_lookup(source_db.tables[key],
+                                    fk['referred_columns']),
+        'enforced': enforced,
+    }
+
+
+def _child_lookup(child_fk, source_db, children):
+    """Statements for finding the source rows that refer to a parent through
+    ``child_fk``; ``query`` is limited to ``children`` rows (the first by key,
+    with ``--seed``)"""
+    child = source_db.tables[(child_fk['constrained_schema'],
+                              child_fk['constrained_table'])]
+    columns = child_fk['constrained_columns']
+    query_all = _key_lookup(child, columns, child.queue_columns)
+    return {
+        'name': '%s(%s)' % (_qualified_name(child.schema, child.name),
+                            ', '.join(columns)),
+        'table': child,
+        'constrained_columns': columns,
+        'referred_columns': child_fk['referred_columns'],
+        'query': query_all.order_by(*_seeded_order(child)).limit(children),
+        'query_all': query_all,
+        # an index led by the first FK column spares the database a scan
+        'indexed': any(ix[:1] == columns[:1] for ix in child.indexes),
+        # whether children are found by batched scans, and the keys of the
+        # parents waiting for the next scan
+        'batched': False,
+        'parents': OrderedDict(),
+    }
+
+
+class _RowCache(object):
+    """Least-recently-used cache of source rows by key
+
+    Misses are cached too (as ``None``), since configured ``constraints``
+    may refer to rows that don't exist."""
+
+    def __init__(self, size):
+        self.size = size
+        self.rows = OrderedDict()
+
+    def fetch(self, key, query):
+        """Return the row cached for ``key``, or run ``query()`` to get it"""
+        if key in self.rows:
+            self.rows.move_to_end(key)
+            return self.rows[key]
+        row = query()
+        self.store(key, row)
+        return row
+
+    def store(self, key, row):
+        if self.size:
+            self.rows[key] = row
+            self.rows.move_to_end(key)
+            if len(self.rows) > self.size:
+                self.rows.popitem(last=False)
+
+
+class _Row(tuple):
+    """A source row kept as a plain tuple in its table's column order
+
+    Rows wait in queues and write buffers by the thousand, where a
+    ``RowProxy`` (with its reference to the result's metadata) costs several
+    times as much memory.  Columns can still be read as a ``RowProxy``'s
+    are (by name, ``Column`` or attribute), and ``params`` gives the dict
+    that inserts take."""
+
+    __slots__ = ()
+    columns = ()
+    positions = {}
+
+    def __getitem__(self, key):
+        if not isinstance(key, (int, slice)):
+            if isinstance(key, sa.sql.ColumnElement):
+                key = key.name
+            key = self.positions[key]
+        return tuple.__getitem__(self, key)
+
+    def __getattr__(self, name):
+        try:
+            return tuple.__getitem__(self, self.positions[name])
+        except KeyError:
+            raise AttributeError(name)
+
+    def keys(self):
+        return list(self.columns)
+
+    def items(self):
+        return list(zip(self.columns, self))
+
+    def params(self):
+        return dict(zip(self.columns, self))
+
+
+class RowBatch(object):
+    """
+    The rows of one table about to be written, sent with
+    ``SIGNAL_ROWS_FLUSHED`` so that handlers can change them in bulk
+
+    Rows can be read and replaced as a sequence of tuples in the order of
+    ``columns`` (``rows``), or a column at a time (``column`` and
+    ``set_column``); the batch keeps whichever form was used last.
+    """
+
+    def __init__(self, columns, rows):
+        self.columns = list(columns)
+        self._rows = list(rows)
+        self._arrays = None
+
+    def __len__(self):
+        if self._arrays is not None:
+            return len(self._arrays[0]) if self._arrays else 0
+        return len(self._rows)
+
+    @property
+    def rows(self):
+        if self._arrays is not None:
+            self._rows = list(zip(*self._arrays))
+            self._arrays = None
+        return self._rows
+
+    @rows.setter
+    def rows(self, rows):
+        self._rows = list(rows)
+        self._arrays = None
+
+    def _columns(self):
+        if self._arrays is None:
+            n_rows = len(self._rows)
+            self._arrays = [list(values) for values in zip(*self._rows)
+                            ] if n_rows else [[] for _ in self.columns]
+            self._rows = None
+        return self._arrays
+
+    def column(self, name):
+        """The values of column ``name``, as a list that may be changed in
+        place"""
+        return self._columns()[self.columns.index(name)]
+
+    def set_column(self, name, values):
+        values = list(values)
+        if len(values) != len(self):
+            raise ValueError("%d values given for %d rows" %
+                             (len(values), len(self)))
+        self._columns()[self.columns.index(name)] = values
+
+    def params(self):
+        """The rows as the dicts that inserts take"""
+        if self._arrays is not None:
+            return [dict(zip(self.columns, values))
+                    for values in zip(*self._arrays)]
+        return [dict(zip(self.columns, row)) for row in self._rows]
+
+
+def _projection(table, columns):
+    """The columns of ``table`` to select (from ``columns``, the columns of
+    the table or of an alias of it), as configured under ``columns`` in the
+    config file: those listed under ``exclude`` are left out (so the target
+    gets their defaults), those under ``truncate`` are cut to the given
+    length, and those under ``replace`` are selected as the given
+    constant"""
+    config = table.column_config
+    dialect = table.bind.engine.dialect.name
+    substr = sa.func.substring if 'mssql' in dialect else sa.func.substr
+    selected = []
+    for col in columns:
+        if col.name in config.get('exclude', []):
+            continue
+        elif col.name in config.get('replace', {}):
+            selected.append(
+                sa.literal(config['replace'][col.name],
+                           type_=col.type).label(col.name))
+        elif col.name in config.get('truncate', {}):
+            selected.append(
+                substr(col, 1, config['truncate'][col.name]).label(col.name))
+        else:
+            selected.append(col)
+    return selected
+
+
+def _check_key_columns(table, columns):
+    """Refuse a ``columns`` config that would change key ``columns``, which
+    rows are looked up and linked by"""
+    changed = _configured_columns(table.column_config).intersection(columns)
+    if changed:
+        raise Exception("Key column(s) %s of %s can not be excluded, "
+                        "truncated or replaced" %
+                        (', '.join(sorted(changed)), table.name))
+
+
+def _configured_columns(config):
+    """Names of the columns that the ``columns`` config of a table
+    changes"""
+    return set(config.get('exclude', [])).union(
+        config.get('truncate', {}), config.get('replace', {}))
+
+
+def _row_type(table):
+    """A ``_Row`` subclass for rows of ``table``"""
+    columns = tuple(col.name for col in table.projection)
+    return type('Row', (_Row, ), {
+        '__slots__': (),
+        'columns': columns,
+        'positions': dict((col, i) for (i, col) in enumerate(columns)),
+    })
+
+
+def _compact(self, row):
+    """``row`` of this table as a ``_Row``"""
+    if row is None or isinstance(row, self.row_type):
+        return row
+    return self.row_type(row[col] for col in self.row_type.columns)
+
+
+def _timed_out(error):
+    """Whether ``error`` is a statement cancelled by ``--timeout``"""
+    orig = error.orig
+    return (getattr(orig, 'pgcode', None) == '57014' or  # query_canceled
+            bool(orig.args) and orig.args[0] in (3024, 1969) or  # MySQL
+            'interrupted' in str(orig))  # SQLite
+
+
+def _prepare_connection(conn):
+    """Set up ``conn``, taken from a caller's engine, the way the ``connect``
+    listener of ``_create_engine`` sets up the connections of its own
+    engines"""
+    if conn.dialect.name == 'sqlite':
+        _register_sqlite_functions(conn.connection.connection, None)
+
+
+def _create_engine(sqla_conn, pool_size):
+    """Create an engine whose pool can hold ``pool_size`` connections.
+
+    Dialects that don't pool connections (file-based SQLite uses
+    ``NullPool``) reject the ``pool_size`` argument, so it is only
+    passed where the dialect's default pool accepts it.
+
+    Compiled statements are cached per engine, so the lookup statements
+    prepared in ``Db.assign_target`` are only compiled to SQL once.
+
+    ``sqla_conn`` may also be an existing ``Engine``, whose pool is then
+    shared (and left at the size it was created with, and without
+    listeners: ``Db`` sets up the connections it takes from it with
+    ``_prepare_connection``)."""
+    execution_options = {
+        'compiled_cache': sa.util.LRUCache(COMPILED_CACHE_SIZE)
+    }
+    if isinstance(sqla_conn, sa.engine.Engine):
+        return sqla_conn.execution_options(**execution_options)
+    url = sa.engine.url.make_url(sqla_conn)
+    pool_class = url.get_dialect().get_pool_class(url)
+    kwargs = {'execution_options': execution_options}
+    if issubclass(pool_class, (sa.pool.QueuePool, sa.pool.SingletonThreadPool)):
+        kwargs['pool_size'] = max(pool_size, len(CONNECTION_ROLES) + 1)
+    engine = sa.create_engine(sqla_conn, **kwargs)
+    if engine.dialect.name == 'sqlite':
+        sa.event.listen(engine, 'connect', _register_sqlite_functions)
+    return engine
+
+
+def _table_config(config, section, schema, table, default=None):
+    """The entry for a table in a section of the config file, which may be
+    keyed by either the qualified (``schema.table``) or plain table name"""
+    entries = config.get(section, {})
+    qualified = "{}.{}".format(schema, table)
+    if qualified in entries:
+        return entries[qualified]
+    return entries.get(table, default)
+
+
+def _upsert(table):
+    """INSERT that overwrites any existing row with the same primary key,
+    or UPDATE by primary key on dialects without an upsert"""
+    pk = [col.name for col in table.primary_key.columns]
+    others = [col.name for col in table.c if col.name not in pk]
+    dialect = table.bind.engine.dialect.name
+    if dialect == 'postgresql':
+        stmt = postgresql.insert(table)
+        if not others:
+            return stmt.on_conflict_do_nothing()
+        return stmt.on_conflict_do_update(
+            index_elements=pk,
+            set_=dict((col, stmt.excluded[col]) for col in others))
+    elif 'mysql' in dialect:
+        stmt = mysql.insert(table)
+        if not others:
+            return stmt.prefix_with('IGNORE')
+        return stmt.on_duplicate_key_update(
+            **dict((col, stmt.inserted[col]) for col in others))
+    elif dialect == 'sqlite':
+        return table.insert().prefix_with('OR REPLACE')
+    return table.update().where(sa.sql.and_(*(
+        table.c[col] == sa.bindparam('key_%d' % i)
+        for (i, col) in enumerate(pk))))
+
+
+def _qualified_name(schema, table):
+    return '{}.{}'.format(schema, table) if schema else table
+
+
+def _load_state(path):
+    """State kept between runs in the ``--cache`` file"""
+    if path and os.path.exists(path):
+        with open(path) as infile:
+            return json.load(infile)
+    return {}
+
+
+def _save_state(path, state):
+    if path:
+        with open(path, 'w') as outfile:
+            json.dump(state, outfile, indent=2, sort_keys=True)
+
+
+def _sqlite_hash(value):
+    return zlib.crc32(value.encode('utf8')) & 0xffffffff
+
+
+def _register_sqlite_functions(dbapi_conn, connection_record):
+    dbapi_conn.create_function('subsetter_hash', 1, _sqlite_hash)
+
+
 def _import_modules(import_list):
     for module_name in import_list:
         __import__(module_name)
 
 
 class Db(object):
-    def __init__(self, sqla_conn, args, schemas=[None]):
+    def __init__(self, sqla_conn, args, schemas=[None], replicas=[]):
+        """``sqla_conn`` is a connection string, an ``Engine`` or a
+        ``Connection``.  Every role shares a given ``Connection``, so the Db
+        sees (and writes within) its caller's transaction."""
         self.args = args
         self.sqla_conn = sqla_conn
         self.schemas = schemas
-        self.engine = sa.create_engine(sqla_conn)
-        self.inspector = Inspector(bind=self.engine)
-        self.conn = self.engine.connect()
+        self.shared_connection = isinstance(sqla_conn, sa.engine.Connection)
+        if self.shared_connection:
+            self.engine = _create_engine(sqla_conn.engine, args.pool_size)
+            self.conn = sqla_conn.execution_options(
+                **self.engine.get_execution_options())
+            self.connections = dict(
+                (role, self.conn) for role in CONNECTION_ROLES)
+        else:
+            self.engine = _create_engine(sqla_conn, args.pool_size)
+            self.conn = self.engine.connect()
+            self.connections = dict(
+                (role, self.engine.connect()) for role in CONNECTION_ROLES)
+        if isinstance(sqla_conn, (sa.engine.Engine, sa.engine.Connection)):
+            for conn in set([self.conn] + list(self.connections.values())):
+                _prepare_connection(conn)
+        self.inspector = Inspector(bind=self.conn)
+        self.replicas = [
+            _create_engine(replica, args.pool_size)
+            for replica in replicas
+        ]
+        self.replica_connections = dict(
+            (role, [replica.connect() for replica in self.replicas])
+            for role in REPLICA_ROLES)
+        for (i, replica) in enumerate(replicas):
+            if isinstance(replica, sa.engine.Engine):
+                for conns in self.replica_connections.values():
+                    _prepare_connection(conns[i])
+        self.next_replica = dict(
+            (role, itertools.cycle(conns))
+            for (role, conns) in self.replica_connections.items())
+        if args.timeout and self.engine.dialect.name not in TIMEOUT_DIALECTS:
+            logging.warning("--timeout is not supported on %s" %
+                            self.engine.dialect.name)
+        self.transaction = None
+        self.snapshot_transactions = []
         self.tables = OrderedDict()
+        self.metadata = []
 
+        catalog = None
+        if self.engine.name == 'postgresql' and not args.per_table_reflection:
+            try:
+                catalog = reflect_catalog(self.conn, self.schemas)
+            except Exception as e:  # it leans on SQLAlchemy internals
+                logging.warning("bulk catalog reflection failed; reflecting "
+                                "table by table\n%s" % str(e))
         for schema in self.schemas:
-            meta = sa.MetaData(
-                bind=self.engine)  # excised schema=schema to prevent errors
-            meta.reflect(schema=schema)
+            meta = sa.MetaData(bind=self.conn if self.shared_connection else
+                               self.engine)  # excised schema=schema to prevent errors
+            self.metadata.append(meta)
+            if catalog is None:
+                meta.reflect(schema=schema)
+            else:
+                build_tables(meta, catalog, schema)
             for tbl in meta.sorted_tables:
                 if args.tables and not _table_matches_any_pattern(
                         tbl.schema, tbl.name, self.args.tables):
@@ -239,39 +951,73 @@ class Db(object):
                     continue
                 tbl.db = self
 
-                if self.engine.name == 'postgresql':
-                    fix_postgres_array_of_enum(self.conn, tbl)
-
                 # TODO: Replace all these monkeypatches with an instance assigment
                 tbl.find_n_rows = types.MethodType(_find_n_rows, tbl)
                 tbl.random_row_func = types.MethodType(_random_row_func, tbl)
-                tbl.fks = self.inspector.get_foreign_keys(tbl.name,
-                                                          schema=tbl.schema)
-                tbl.pk = self.inspector.get_primary_keys(tbl.name,
-                                                         schema=tbl.schema)
-                if not tbl.pk:
-                    tbl.pk = [
-                        d['name']
-                        for d in self.inspector.get_columns(tbl.name,
-                                                            schema=tbl.schema)
+                if catalog is None:
+                    if self.engine.name == 'postgresql':
+                        fix_postgres_array_of_enum(self.conn, tbl)
+                    tbl.n_rows_estimate = None
+                    tbl.fks = self.inspector.get_foreign_keys(
+                        tbl.name, schema=tbl.schema)
+                    tbl.pk = self.inspector.get_primary_keys(
+                        tbl.name, schema=tbl.schema)
+                    tbl.indexes = [
+                        ix['column_names']
+                        for ix in self.inspector.get_indexes(
+                            tbl.name, schema=tbl.schema)
                     ]
+                else:
+                    entry = catalog[(tbl.schema, tbl.name)]
+                    tbl.n_rows_estimate = entry['reltuples']
+                    tbl.fks = [dict(fk) for fk in entry['fks']]
+                    tbl.pk = list(entry['pk'])
+                    tbl.indexes = list(entry['indexes'])
+                tbl.column_config = _table_config(args.config, 'columns',
+                                                  tbl.schema, tbl.name, {})
+                tbl.projection = _projection(tbl, tbl.c)
+                filters = _table_config(args.config, 'filters', tbl.schema,
+                                        tbl.name, {})
+                tbl.sample_filter = sa.text(
+                    filters['where']) if filters.get('where') else None
+                tbl.sample_order = sa.text(
+                    filters['order_by']) if filters.get('order_by') else None
+                tbl.sample_query = types.MethodType(_sample_query, tbl)
+                if tbl.pk:
+                    _check_key_columns(tbl, tbl.pk)
+                    tbl.indexes.append(tbl.pk)
+                else:  # rows are told apart by their unchanged columns
+                    changed = _configured_columns(tbl.column_config)
+                    tbl.pk = [
+                        col.name for col in tbl.c if col.name not in changed
+                    ] or [col.name for col in tbl.projection]
                 tbl.filtered_by = types.MethodType(_filtered_by, tbl)
                 tbl.by_pk = types.MethodType(_by_pk, tbl)
+                tbl.by_keys = types.MethodType(_by_keys, tbl)
+                tbl.hash_bucket = types.MethodType(_hash_bucket, tbl)
+                tbl.hashed_rows = types.MethodType(_hashed_rows, tbl)
                 tbl.pk_val = types.MethodType(_pk_val, tbl)
+                tbl.row_type = _row_type(tbl)
+                tbl.compact = types.MethodType(_compact, tbl)
+                # what child lookups select to queue the rows they find
+                if tbl.primary_key.columns:
+                    tbl.queue_columns = [tbl.c[col] for col in tbl.pk]
+                else:
+                    tbl.queue_columns = tbl.projection
+                tbl.fetch_queued = types.MethodType(_fetch_queued, tbl)
                 tbl.child_fks = []
-                estimate_rows = not _table_matches_any_pattern(
-                    tbl.schema, tbl.name, self.args.full_tables)
-                tbl.find_n_rows(estimate=estimate_rows)
                 self.tables[(tbl.schema, tbl.name)] = tbl
-        all_constraints = args.config.get('constraints', {})
+        self.count_rows()
         for ((tbl_schema, tbl_name), tbl) in self.tables.items():
-            qualified = "{}.{}".format(tbl_schema, tbl_name)
-            if qualified in all_constraints:
-                constraints = all_constraints[qualified]
-            else:
-                constraints = all_constraints.get(tbl_name, [])
+            constraints = _table_config(args.config, 'constraints',
+                                        tbl_schema, tbl_name, [])
             tbl.constraints = constraints
             for fk in (tbl.fks + constraints):
+                _check_key_columns(tbl, fk['constrained_columns'])
+                _check_key_columns(
+                    self.tables[(fk['referred_schema'],
+                                 fk['referred_table'])],
+                    fk['referred_columns'])
                 fk['constrained_schema'] = tbl_schema
                 fk['constrained_table'] = tbl_name  # TODO: check against constrained_table
                 self.tables[(fk['referred_schema'], fk['referred_table']
@@ -280,134 +1026,663 @@ class Db(object):
     def __repr__(self):
         return "Db('%s')" % self.sqla_conn
 
+    def rebind(self, sqla_conn):
+        """Work within ``sqla_conn``, another ``Connection`` of the engine
+        whose connection this Db was reflected through, keeping the
+        reflected tables"""
+        self.sqla_conn = sqla_conn
+        self.conn = sqla_conn.execution_options(
+            **self.engine.get_execution_options())
+        self.connections = dict((role, self.conn) for role in CONNECTION_ROLES)
+        _prepare_connection(self.conn)
+        self.inspector = Inspector(bind=self.conn)
+        for meta in self.metadata:
+            meta.bind = self.conn
+
+    def count_rows(self):
+        """Count (or, except for ``--full-table`` tables, estimate) the rows
+        of each table"""
+        for tbl in self.tables.values():
+            estimate_rows = not _table_matches_any_pattern(
+                tbl.schema, tbl.name, self.args.full_tables)
+            tbl.find_n_rows(estimate=estimate_rows)
+
+    def connection(self, role):
+        """The connection for ``role``; work in ``REPLICA_ROLES`` goes to each
+        read replica in turn, if there are any"""
+        if self.replicas and role in REPLICA_ROLES:
+            return next(self.next_replica[role])
+        return self.connections[role]
+
+    def guarded_fetch(self, role, qry, params={}):
+        """All the rows of ``qry`` on the ``role`` connection, cancelled
+        after ``--timeout`` seconds
+
+        Only these queries (sampling and child lookups, which have cheaper
+        fallbacks) are limited.  On PostgreSQL the query runs in a savepoint
+        (or transaction) with ``SET LOCAL statement_timeout``, rolled back
+        afterwards so that neither the setting nor a cancelled query outlives
+        it; MySQL gets a ``MAX_EXECUTION_TIME`` hint (``SELECT`` only) and
+        SQLite a progress handler."""
+        conn = self.connection(role)
+        timeout = self.args.timeout
+        dialect = self.engine.dialect.name
+        if not timeout or dialect not in TIMEOUT_DIALECTS:
+            return conn.execute(qry, params).fetchall()
+        if dialect == 'postgresql':
+            transaction = (conn.begin_nested()
+                           if conn.in_transaction() else conn.begin())
+            try:
+                conn.execute('SET LOCAL statement_timeout = %d' %
+                             (timeout * 1000))
+                return conn.execute(qry, params).fetchall()
+            finally:
+                transaction.rollback()  # it only read
+        if dialect == 'mysql':
+            return conn.execute(
+                qry.prefix_with('/*+ MAX_EXECUTION_TIME(%d) */' %
+                                (timeout * 1000)), params).fetchall()
+        deadline = time.time() + timeout
+        dbapi_conn = conn.connection.connection
+        dbapi_conn.set_progress_handler(lambda: time.time() > deadline,
+                                        SQLITE_PROGRESS_STEPS)
+        try:
+            return conn.execute(qry, params).fetchall()
+        finally:
+            dbapi_conn.set_progress_handler(None, 0)
+
+    def record_strategy(self, kind, name, strategy):
+        """Remember, in the ``--cache`` file, the ``strategy`` that the last
+        ``kind`` of query for ``name`` fell back to after a timeout"""
+        self.state.setdefault('strategies', {}).setdefault(kind,
+                                                           {})[name] = strategy
+
+    def close(self):
+        for conns in self.replica_connections.values():
+            for conn in conns:
+                conn.close()
+        if self.shared_connection:  # the caller's to close
+            return
+        for conn in self.connections.values():
+            conn.close()
+        self.conn.close()
+
     def assign_target(self, target_db):
+        self.state = _load_state(self.args.cache)
+        self.parent_cache = _RowCache(self.args.parent_cache)
+        self.nested = []
+        self.child_scans = []
+        child_strategies = self.state.get('strategies', {}).get('children', {})
         for ((tbl_schema, tbl_name), tbl) in self.tables.items():
-            tbl._random_row_gen_fn = types.MethodType(_random_row_gen_fn, tbl)
+            tbl._random_row_gen_fn = types.MethodType(_sampled_row_gen_fn, tbl)
             tbl.random_rows = tbl._random_row_gen_fn()
             tbl.next_row = types.MethodType(_next_row, tbl)
             target = target_db.tables[(tbl_schema, tbl_name)]
-            target.requested = deque()
-            target.required = deque()
+            target.source = tbl
+            tbl.target = target
+            # keys of the rows to create (see ``request``), and batches of
+            # rows fetched for them (with their keys)
+            target.requested = OrderedDict()
+            target.required = OrderedDict()
+            target.fetched_requested = deque()
+            target.fetched_required = deque()
+            target.fetched_keys = set()
             target.pending = dict()
+            target.replacing = dict()
             target.done = set()
+            target.levels = dict()
             target.fetch_all = False
+            target.copied = False
             if _table_matches_any_pattern(tbl.schema, tbl.name,
                                           self.args.full_tables):
                 target.n_rows_desired = tbl.n_rows
                 target.fetch_all = True
             else:
-                if tbl.n_rows:
-                    if self.args.logarithmic:
-                        target.n_rows_desired = int(math.pow(10, math.log10(
-                            tbl.n_rows) * self.args.fraction)) or 1
-                    else:
-                        target.n_rows_desired = int(tbl.n_rows *
-                                                    self.args.fraction) or 1
-                else:
-                    target.n_rows_desired = 0
-            target.source = tbl
-            tbl.target = target
+                target.n_rows_desired = self.n_rows_desired(
+                    tbl, self.args.fraction)
+            target.inserter = target.insert()
+            target.upserter = _upsert(target)
+            target.parent_lookups = [
+                _parent_lookup(fk, self, target_db, enforced=True)
+                for fk in target.fks
+            ] + [
+                _parent_lookup(constraint, self, target_db, enforced=False)
+                for constraint in target.constraints
+            ]
+            target.child_lookups = [
+                _child_lookup(child_fk, self, self.args.children)
+                for child_fk in target.child_fks
+            ]
+            for lookup in target.child_lookups:
+                if not self.args.child_scan_batch:
+                    continue
+                if not lookup['indexed']:
+                    logging.info("%s.%s is not indexed; scanning for "
+                                 "children in batches" %
+                                 (lookup['table'].name,
+                                  lookup['constrained_columns'][0]))
+                    self.scan_for_children(lookup)
+                elif child_strategies.get(lookup['name']) == 'scan':
+                    self.scan_for_children(lookup)
             target.completeness_score = types.MethodType(_completeness_score,
                                                          target)
             logging.debug("assigned methods to %s" % target.name)
 
+    def n_rows_desired(self, tbl, fraction):
+        if tbl.target.fetch_all:
+            return tbl.n_rows
+        if not tbl.n_rows:
+            return 0
+        if self.args.logarithmic:
+            return int(math.pow(10, math.log10(tbl.n_rows) * fraction)) or 1
+        return int(tbl.n_rows * fraction) or 1
+
     def confirm(self):
+        stats = planner.column_stats(self)
+        plan = planner.estimate(
+            self, dict((key, tbl.target.n_rows_desired)
+                       for (key, tbl) in self.tables.items()),
+            self.args.children, stats)
         message = []
         for (tbl_schema, tbl_name) in sorted(self.tables, key=lambda t: t[1]):
             tbl = self.tables[(tbl_schema, tbl_name)]
-            message.append("Create %d rows from %d in %s.%s" %
-                           (tbl.target.n_rows_desired, tbl.n_rows,
-                            tbl_schema or '', tbl_name))
+            estimate = plan[(tbl_schema, tbl_name)]
+            message.append(
+                "Create %d rows from %d in %s.%s "
+                "(estimated %d rows, %s, %d queries)" %
+                (tbl.target.n_rows_desired, tbl.n_rows, tbl_schema or '',
+                 tbl_name, estimate['rows'], planner.human_size(
+                     estimate['bytes']), estimate['queries']))
         print("\n".join(sorted(message)))
+        size = planner.total(plan, 'bytes')
+        print("Estimated total: %d rows, %s, %d queries" %
+              (planner.total(plan, 'rows'), planner.human_size(size),
+               planner.total(plan, 'queries')))
+        if self.args.budget and size > self.args.budget:
+            print("That exceeds the budget of %s; to stay within it, try" %
+                  planner.human_size(self.args.budget))
+            suggestions = planner.suggest(
+                self, lambda fraction: dict(
+                    (key, self.n_rows_desired(tbl, fraction))
+                    for (key, tbl) in self.tables.items()),
+                self.args.fraction, self.args.children, self.args.budget,
+                stats)
+            for (children, fraction, size) in suggestions:
+                print("  --children=%d with fraction %g (%s)" %
+                      (children, fraction, planner.human_size(size)))
+            if not suggestions:
+                print("  a larger budget; no smaller fraction fits")
         if self.args.yes:
             return True
         response = input("Proceed? (Y/n) ").strip().lower()
         return (not response) or (response[0] == 'y')
 
-    def create_row_in(self, source_row, target_db, target, prioritized=False):
+    def create_row_in(self,
+                      source_row,
+                      target_db,
+                      target,
+                      prioritized=False,
+                      replace=False,
+                      level=None,
+                      children=True):
+        """Add ``source_row`` to ``target`` with its parent rows, and request
+        its child rows (unless ``children`` is false, for callers that
+        request them in bulk).  With ``replace``, a row that is already in the
+        target is written again (used by ``--refresh`` for changed rows).
+
+        With nested targets, the row also goes into the first ``level`` of
+        them (by default, as many as its own draw puts it in; see
+        ``nested_level``), and so do its parent rows."""
         logging.debug('create_row_in %s:%s ' %
                       (target.name, target.pk_val(source_row)))
+        source_row = target.source.compact(source_row)
 
         pks = hashable((source_row[key] for key in target.pk))
         row_exists = pks in target.pending or pks in target.done
         logging.debug("Row exists? %s" % str(row_exists))
-        if row_exists and not prioritized:
+        replace = replace and row_exists and bool(target.primary_key.columns)
+        if level is None:
+            level = self.nested_level(target.source, pks)
+        nested_from = target.levels.get(pks, 0)
+        if row_exists and not (prioritized or replace or level > nested_from):
             return
 
-        if not row_exists:
-            # make sure that all required rows are in parent table(s)
-            for fk in target.fks:
-                target_parent = target_db.tables[(fk['referred_schema'], fk[
-                    'referred_table'])]
-                slct = sa.sql.select([target_parent, ])
-                any_non_null_key_columns = False
-                for (parent_col, child_col) in zip(fk['referred_columns'],
-                                                   fk['constrained_columns']):
-                    slct = slct.where(target_parent.c[parent_col] ==
-                                      source_row[child_col])
-                    if source_row[child_col] is not None:
-                        any_non_null_key_columns = True
-                        break
-                if any_non_null_key_columns:
-                    target_parent_row = target_db.conn.execute(slct).first()
-                    if not target_parent_row:
-                        source_parent_row = self.conn.execute(slct).first()
-                        self.create_row_in(source_parent_row, target_db,
-                                           target_parent)
-
-            # make sure that all referenced rows are in referenced table(s)
-            for constraint in target.constraints:
-                target_referred = target_db.tables[(constraint[
-                    'referred_schema'], constraint['referred_table'])]
-                slct = sa.sql.select([target_referred, ])
-                any_non_null_key_columns = False
-                for (referred_col, constrained_col) in zip(
-                        constraint['referred_columns'],
-                        constraint['constrained_columns']):
-                    slct = slct.where(target_referred.c[referred_col] ==
-                                      source_row[constrained_col])
-                    if source_row[constrained_col] is not None:
-                        any_non_null_key_columns = True
-                        break
-                if any_non_null_key_columns:
-                    target_referred_row = target_db.conn.execute(slct).first()
-                    if not target_referred_row:
-                        source_referred_row = self.conn.execute(slct).first()
-                        # because constraints aren't enforced like real FKs, the referred row isn't guaranteed to exist
-                        if source_referred_row:
-                            self.create_row_in(source_referred_row, target_db,
-                                               target_referred)
+        if replace or level > nested_from or not row_exists:
+            # make sure that all required rows are in parent table(s), and
+            # all referenced rows are in referenced table(s)
+            for lookup in target.parent_lookups:
+                if lookup['table'].copied:
+                    continue  # every source row is already in the target
+                params = _key_params(source_row,
+                                     lookup['constrained_columns'])
+                if None in params.values():
+                    continue  # keys containing NULL aren't enforced
+                if not level:
+                    target_parent_row = target_db.connection(
+                        'write').execute(lookup['target_query'],
+                                         params).first()
+                    if target_parent_row:
+                        continue
+                source_parent_row = self.parent_cache.fetch(
+                    self.parent_cache_key(lookup, source_row),
+                    lambda: lookup['table'].source.compact(
+                        self.connection('lookup').execute(
+                            lookup['source_query'], params).first()))
+                # because constraints aren't enforced like real FKs, the referred row isn't guaranteed to exist
+                if source_parent_row or lookup['enforced']:
+                    self.create_row_in(source_parent_row,
+                                       target_db,
+                                       lookup['table'],
+                                       level=level)
 
             pks = hashable((source_row[key] for key in target.pk))
-            target.n_rows += 1
-
-            if self.args.buffer == 0:
-                target_db.insert_one(target, pks, source_row)
+            if replace or not row_exists:
+                if not row_exists:
+                    target.n_rows += 1
+                self.add_row(target_db, target, pks, source_row, replace)
+                signal(SIGNAL_ROW_ADDED).send(self,
+                                              source_row=source_row,
+                                              target_db=target_db,
+                                              target_table=target,
+                                              prioritized=prioritized)
+            for (nested_db, _) in self.nested[nested_from:level]:
+                nested_table = nested_db.tables[(target.schema, target.name)]
+                self.add_row(nested_db, nested_table, pks, source_row)
+            if level > nested_from:
+                target.levels[pks] = level
+
+        if not children or (row_exists and not (prioritized or replace)):
+            return
+        self.request_row_children(source_row, target.child_lookups,
+                                  prioritized)
+
+    def request_row_children(self, source_row, lookups, prioritized):
+        """Request the child rows of ``source_row`` found by ``lookups`` (up
+        to ``--children`` of each unless ``prioritized``), or leave its key
+        for the next scan of children that are found by batched scans"""
+        for lookup in lookups:
+            child = lookup['table']
+            if child.target.copied:
+                continue
+            if lookup['batched']:
+                key = hashable(source_row[col]
+                               for col in lookup['referred_columns'])
+                if None not in key:
+                    lookup['parents'][key] = (prioritized or
+                                              lookup['parents'].get(key))
+                if len(lookup['parents']) >= self.args.child_scan_batch:
+                    self.scan_children(lookup)
+                continue
+            params = _key_params(source_row, lookup['referred_columns'])
+            if prioritized:
+                slct = lookup['query_all']
             else:
-                target.pending[pks] = source_row
-            signal(SIGNAL_ROW_ADDED).send(self,
-                                          source_row=source_row,
-                                          target_db=target_db,
-                                          target_table=target,
-                                          prioritized=prioritized)
-
-        for child_fk in target.child_fks:
-            child = self.tables[(child_fk['constrained_schema'], child_fk[
-                'constrained_table'])]
-            slct = sa.sql.select([child])
-            for (child_col, this_col) in zip(child_fk['constrained_columns'],
-                                             child_fk['referred_columns']):
-                slct = slct.where(child.c[child_col] == source_row[this_col])
-            if not prioritized:
-                slct = slct.limit(self.args.children)
-            for (n, desired_row) in enumerate(self.conn.execute(slct)):
-                if prioritized:
-                    child.target.required.append((desired_row, prioritized))
-                elif (n == 0):
-                    child.target.requested.appendleft((desired_row, prioritized
-                                                       ))
+                slct = lookup['query']
+            try:
+                desired_rows = self.guarded_fetch('fetch', slct, params)
+            except sa.exc.DBAPIError as error:
+                if not (_timed_out(error) and self.args.child_scan_batch):
+                    raise
+                logging.warning("looking up children in %s timed out; "
+                                "scanning for them in batches instead" %
+                                child.name)
+                self.scan_for_children(lookup)
+                self.record_strategy('children', lookup['name'], 'scan')
+                lookup['parents'][hashable(
+                    source_row[col]
+                    for col in lookup['referred_columns'])] = prioritized
+                continue
+            for (n, desired_row) in enumerate(desired_rows):
+                self.request(child, desired_row, prioritized, first=(n == 0))
+
+    def request(self, tbl, row, prioritized, first=False):
+        """
+        Queue ``row`` of the source table ``tbl`` for creation in the target
+
+        Prioritized rows go to the target's ``required`` queue, and others
+        to ``requested`` (at the front if ``first``).  The queues are keyed
+        by primary key, so each row waits in them only once, and hold only
+        the key (``row`` need only have the key columns) unless the table
+        has no primary key; rows are fetched in batches when they're due.
+        ``--max-queue`` caps the ``requested`` queue.
+
+        Rows already fetched, or created (in as many nested targets as
+        their own draw puts them in), are not requested again.
+        """
+        target = tbl.target
+        pks = hashable(row[col] for col in tbl.pk)
+        if pks in target.required:
+            return
+        if not prioritized and (pks in target.fetched_keys or (
+                (pks in target.done or pks in target.pending)
+                and target.levels.get(pks, 0) >= self.nested_level(tbl, pks))):
+            return
+        entry = None if tbl.primary_key.columns else tbl.compact(row)
+        if prioritized:
+            target.requested.pop(pks, None)
+            target.required[pks] = entry
+            return
+        if pks not in target.requested:
+            if len(target.requested) >= (self.args.max_queue or
+                                         float('inf')):
+                return
+            target.requested[pks] = entry
+        if first:
+            target.requested.move_to_end(pks, last=False)
+
+    def parent_cache_key(self, lookup, row):
+        return (lookup['table'].schema, lookup['table'].name,
+                tuple(lookup['referred_columns']),
+                hashable(row[col] for col in lookup['constrained_columns']))
+
+    def prefetch_parents(self, tbl, rows):
+        """Fetch the ancestors of ``rows`` of ``tbl`` into the parent cache
+        a generation at a time, with batched ``IN`` queries, so that
+        ``create_row_in`` finds them without a query per row"""
+        if not self.parent_cache.size:
+            return
+        seen = set()
+        generation = [(tbl, rows)]
+        while generation:
+            parents = []
+            for (child, child_rows) in generation:
+                for lookup in child.target.parent_lookups:
+                    if lookup['table'].copied:
+                        continue
+                    keys = OrderedDict()
+                    for row in child_rows:
+                        key = self.parent_cache_key(lookup, row)
+                        if None not in key[3] and key not in seen:
+                            keys[key[3]] = key
+                    if not keys:
+                        continue
+                    seen.update(keys.values())
+                    parent = lookup['table'].source
+                    found = []
+                    for parent_row in parent.by_keys(lookup['referred_columns'],
+                                                     list(keys)):
+                        parent_row = parent.compact(parent_row)
+                        key = hashable(parent_row[col]
+                                       for col in lookup['referred_columns'])
+                        if key in keys:
+                            self.parent_cache.store(keys.pop(key), parent_row)
+                            found.append(parent_row)
+                    for key in keys.values():
+                        self.parent_cache.store(key, None)
+                    if found:
+                        parents.append((parent, found))
+            generation = parents
+
+    def request_children(self, tbl, rows):
+        """Require all the children of ``rows`` of ``tbl``, found with
+        batched ``IN`` queries (or the batched scans of unindexed keys)"""
+        for lookup in tbl.target.child_lookups:
+            child = lookup['table']
+            if child.target.copied:
+                continue
+            keys = OrderedDict()
+            for row in rows:
+                key = hashable(row[col] for col in lookup['referred_columns'])
+                if None not in key:
+                    keys[key] = True
+            if lookup['batched']:
+                lookup['parents'].update(keys)
+                continue
+            for desired_row in child.by_keys(lookup['constrained_columns'],
+                                             list(keys), child.queue_columns):
+                self.request(child, desired_row, True)
+
+    def forced_rows(self):
+        """``(table, rows)`` for each table with rows to force into the
+        target: those given with ``--force``, and those chosen by a ``where``
+        predicate or listed in a ``keys_file`` under ``force`` in the config
+        file
+
+        ``--force`` values are matched against the first key column.  Keys
+        in a ``keys_file`` give every primary key column, or for tables
+        without a primary key, the same number of leading columns each."""
+        names = set()
+        for (tbl_schema, tbl_name) in self.tables:
+            names.update((tbl_name, _qualified_name(tbl_schema, tbl_name)))
+        unknown = (set(self.args.force_rows) |
+                   set(self.args.config.get('force', {}))) - names
+        if unknown:
+            raise Exception('Can not force rows of unknown table(s) %s' %
+                            ', '.join(sorted(unknown)))
+        for ((tbl_schema, tbl_name), tbl) in self.tables.items():
+            forced = []
+            for name in set((tbl_name, _qualified_name(tbl_schema,
+                                                       tbl_name))):
+                forced.extend(
+                    (pk, ) for pk in self.args.force_rows.get(name, []))
+            listed = []
+            config = _table_config(self.args.config, 'force', tbl_schema,
+                                   tbl_name, {})
+            if config.get('keys_file'):
+                with open(config['keys_file']) as keys_file:
+                    listed = [tuple(key) for key in csv.reader(keys_file)
+                              if key]
+            width = len(tbl.pk)
+            if listed and not tbl.primary_key.columns:
+                width = min(width, len(listed[0]))
+            if any(len(key) != width for key in listed):
+                raise Exception('Keys in %s must each have %d column(s) (%s)' %
+                                (config['keys_file'], width, ', '.join(
+                                    tbl.pk[:width])))
+            for (columns, keys) in ((tbl.pk[:1], forced),
+                                    (tbl.pk[:width], listed)):
+                if not keys:
+                    continue
+                rows = list(tbl.by_keys(columns, keys))
+                if len(rows) < len(keys):
+                    logging.warn("%d of the rows requested from %s were not "
+                                 "found in source db, could not create" %
+                                 (len(keys) - len(rows), tbl_name))
+                yield (tbl, rows)
+            if config.get('where'):
+                qry = sa.sql.select(tbl.projection).where(sa.text(
+                    config['where'])).execution_options(stream_results=True)
+                yield (tbl, self.connection('sample').execute(qry))
+
+    def create_forced_rows(self, target_db):
+        """Create the forced rows, with their parents and all of their
+        descendants, a batch at a time"""
+        batch_size = self.args.buffer or 1000
+        for (tbl, rows) in self.forced_rows():
+            rows = iter(rows)
+            while True:
+                batch = [tbl.compact(row)
+                         for row in itertools.islice(rows, batch_size)]
+                if not batch:
+                    break
+                self.prefetch_parents(tbl, batch)
+                for row in batch:
+                    self.create_row_in(row,
+                                       target_db,
+                                       tbl.target,
+                                       prioritized=True,
+                                       level=len(self.nested),
+                                       children=False)
+                self.request_children(tbl, batch)
+                if target_db.pending > self.args.buffer > 0:
+                    self.flush_targets(target_db)
+
+    def add_row(self, target_db, target, pks, source_row, replace=False):
+        """Write ``source_row`` to ``target`` now (with ``--buffer=0``) or
+        at the next flush"""
+        if self.args.buffer == 0:
+            target_db.insert_one(target, pks, source_row, replace=replace)
+        elif pks in target.done:
+            target.replacing[pks] = source_row
+        else:
+            target.pending[pks] = source_row
+
+    def nested_level(self, tbl, pks):
+        """
+        How many of the nested targets a row of ``tbl`` belongs to by its own
+        draw
+
+        Each row's draw is a fixed hash of its key (and ``--seed``), and a
+        nested target takes the rows drawn below its share of the main
+        target's rows of the table (``tbl.nested_shares``), so every smaller
+        subset lies within the larger ones.
+        """
+        if not self.nested:
+            return 0
+        draw = (zlib.crc32(repr((self.args.seed, pks)).encode('utf8')) &
+                0xffffffff) / float(2**32)
+        return sum(1 for share in tbl.nested_shares if draw < share)
+
+    def assign_nested_targets(self, nested):
+        """Also write smaller subsets, each nested within the larger ones,
+        to the ``(Db, fraction)`` pairs of ``nested``"""
+        if nested and self.args.refresh:
+            raise Exception('Nested targets can not be refreshed')
+        self.nested = sorted(nested, key=lambda pair: pair[1], reverse=True)
+        for (nested_db, fraction) in self.nested:
+            if fraction >= self.args.fraction:
+                raise Exception('Nested target %s must have a smaller '
+                                'fraction than the main target' % nested_db)
+            for table in nested_db.tables.values():
+                table.pending = dict()
+                table.replacing = dict()
+                table.done = set()
+                table.inserter = table.insert()
+                table.upserter = _upsert(table)
+        for tbl in self.tables.values():
+            # rows desired at each nested fraction, per row desired at the
+            # main one (not simply the ratio of fractions with -l)
+            tbl.nested_shares = [
+                self.n_rows_desired(tbl, fraction) /
+                float(tbl.target.n_rows_desired or 1)
+                for (_, fraction) in self.nested
+            ]
+
+    def flush_targets(self, target_db):
+        """Flush the target and any nested targets"""
+        target_db.flush()
+        for (nested_db, _) in self.nested:
+            nested_db.flush()
+
+    def begin_snapshot(self, snapshot_id=None):
+        """Read this (source) database inside a consistent snapshot
+
+        Each role connection opens a read-only transaction.  On PostgreSQL
+        they all share one snapshot, exported by the first connection (or
+        imported from ``snapshot_id``, so that outside workers can share it
+        too); on MySQL each connection gets its own consistent snapshot.
+        Other dialects use their default isolation level.  Connections to
+        read replicas each read in a snapshot of their own, since a snapshot
+        can't be shared between servers.  A shared ``Connection`` reads in
+        its caller's transaction as it is."""
+        dialect = self.engine.dialect.name
+        replica_conns = [
+            conn for conns in self.replica_connections.values()
+            for conn in conns
+        ]
+        own_conns = [] if self.shared_connection else [
+            self.connections[role] for role in CONNECTION_ROLES
+        ]
+        for conn in own_conns + replica_conns:
+            self.snapshot_transactions.append(conn.begin())
+            if dialect == 'postgresql':
+                conn.execute('SET TRANSACTION ISOLATION LEVEL '
+                             'REPEATABLE READ READ ONLY')
+                if conn in replica_conns:
+                    continue
+                if snapshot_id:
+                    conn.execute("SET TRANSACTION SNAPSHOT '%s'" %
+                                 snapshot_id)
                 else:
-                    child.target.requested.append((desired_row, prioritized))
+                    snapshot_id = conn.execute(
+                        'SELECT pg_export_snapshot()').scalar()
+                    logging.info("reading source in snapshot %s" %
+                                 snapshot_id)
+            elif dialect == 'mysql':
+                conn.execute('START TRANSACTION WITH CONSISTENT SNAPSHOT, '
+                             'READ ONLY')
+
+    def end_snapshot(self):
+        for transaction in self.snapshot_transactions:
+            transaction.rollback()
+        self.snapshot_transactions = []
+
+    def begin(self):
+        """Start a write transaction, committed every ``--commit-rows``
+        rows or ``--commit-seconds`` seconds, whichever comes first"""
+        self.transaction = self.connections['write'].begin()
+        self.uncommitted = 0
+        self.committed_at = time.time()
+
+    def commit(self):
+        if self.transaction is not None:
+            self.transaction.commit()
+            self.transaction = None
+
+    def _wrote(self, n_rows):
+        if self.transaction is None:
+            return
+        self.uncommitted += n_rows
+        if ((self.args.commit_rows
+             and self.uncommitted >= self.args.commit_rows) or
+            (self.args.commit_seconds and
+             time.time() - self.committed_at >= self.args.commit_seconds)):
+            logging.debug("committing %d rows" % self.uncommitted)
+            self.commit()
+            self.begin()
+
+    def scan_for_children(self, lookup):
+        """Find the children of ``lookup`` by batched scans from now on"""
+        lookup['batched'] = True
+        if lookup not in self.child_scans:
+            self.child_scans.append(lookup)
+
+    def scan_children(self, lookup):
+        """Request the children of a batch of parents in one pass over the
+        child table, instead of one unindexed lookup per parent"""
+        parents = lookup['parents']
+        lookup['parents'] = OrderedDict()
+        child = lookup['table']
+        logging.debug("scanning %s for children of %d parents" %
+                      (child.name, len(parents)))
+        found = dict.fromkeys(parents, 0)
+        queued = set(col.name for col in child.queue_columns)
+        qry = sa.sql.select(child.queue_columns + [
+            child.c[col] for col in lookup['constrained_columns']
+            if col not in queued
+        ]).order_by(*_seeded_order(child)).execution_options(
+            stream_results=True)
+        for desired_row in self.connection('fetch').execute(qry):
+            key = hashable(desired_row[col]
+                           for col in lookup['constrained_columns'])
+            if key not in parents:
+                continue
+            prioritized = parents[key]
+            if not prioritized and found[key] >= self.args.children:
+                continue
+            self.request(child, desired_row, prioritized,
+                         first=(found[key] == 0))
+            found[key] += 1
+
+    def scan_all_children(self, child=None):
+        """Run the waiting batched child scans; return whether there were any
+
+        With ``child``, only its own scans run, and only once it has no other
+        queued rows to create, so that parents gather into whole batches
+        (full batches are scanned as soon as they fill, in ``create_row_in``)
+        instead of being scanned for a few at a time."""
+        if child is not None:
+            target = child.target
+            if (target.required or target.fetched_required
+                    or target.requested or target.fetched_requested):
+                return False
+        waiting = [
+            lookup for lookup in self.child_scans
+            if lookup['parents'] and child in (None, lookup['table'])
+        ]
+        for lookup in waiting:
+            self.scan_children(lookup)
+        return bool(waiting)
 
     @property
     def pending(self):
@@ -415,36 +1690,182 @@ class Db(object):
             lambda count, table: count + len(table.pending),
             self.tables.values(), 0)
 
-    def insert_one(self, table, pk, values):
-        self.conn.execute(table.insert(), values)
+    def write_params(self, table, rows):
+        """Insert parameters for ``rows`` of ``table``, after any
+        ``SIGNAL_ROWS_FLUSHED`` handlers have seen them as a ``RowBatch``
+
+        Handlers may change and reorder rows, but not which rows (by key)
+        are written: their keys are already done, and their children
+        requested, so leaving any out would orphan those children."""
+        rows_flushed = signal(SIGNAL_ROWS_FLUSHED)
+        if not rows_flushed.receivers:
+            return [row.params() for row in rows]
+        batch = RowBatch(type(rows[0]).columns, rows)
+        rows_flushed.send(self, target_table=table, batch=batch)
+        params = batch.params()
+        pk = [col.name for col in table.primary_key.columns]
+        if len(params) != len(rows) or (pk and set(
+                tuple(param[col] for col in pk) for param in params) != set(
+                    tuple(row[col] for col in pk) for row in rows)):
+            raise Exception('%s handlers must not add, drop or rekey rows '
+                            '(of %s)' % (SIGNAL_ROWS_FLUSHED, table.name))
+        return params
+
+    def insert_one(self, table, pk, values, replace=False):
+        if replace:
+            self.replace(table, {pk: values})
+            return
+        self.connection('write').execute(table.inserter,
+                                         self.write_params(table, [values]))
         table.done.add(pk)
+        self._wrote(1)
+
+    def replace(self, table, rows):
+        """Write ``rows`` (by key) over the target rows with the same keys"""
+        params = self.write_params(table, list(rows.values()))
+        if isinstance(table.upserter, sa.sql.expression.Update):
+            # by each row's own key, since handlers may reorder rows
+            pk = [col.name for col in table.primary_key.columns]
+            for param in params:
+                param.update(
+                    ('key_%d' % i, param[col]) for (i, col) in enumerate(pk))
+        self.connection('write').execute(table.upserter, params)
+        self._wrote(len(params))
 
     def flush(self):
         for table in self.tables.values():
-            if not table.pending:
+            if table.pending:
+                params = self.write_params(table,
+                                           list(table.pending.values()))
+                self.connection('write').execute(table.inserter, params)
+                table.done = table.done.union(table.pending.keys())
+                self._wrote(len(params))
+                table.pending = dict()
+            if table.replacing:
+                self.replace(table, table.replacing)
+                table.replacing = dict()
+
+    def load_existing(self, target_db):
+        """Register the keys of the rows already in the target as done"""
+        for target in target_db.tables.values():
+            qry = sa.sql.select([target.c[col] for col in target.pk])
+            for row in target_db.connection('write').execute(qry):
+                target.done.add(hashable(row))
+            target.n_rows = len(target.done)
+
+    def refresh_changed(self, target_db):
+        """Overwrite the subset's rows that changed in the source since the
+        target was last refreshed
+
+        A table's changes are found by the column named for it under
+        ``refresh_columns`` in the config file: rows where it is later than
+        its latest value in the target are written again, along with any new
+        parent rows they need, if their keys are already in the target.
+        Other changed rows are left to the sampler, like any source row."""
+        for ((tbl_schema, tbl_name), tbl) in self.tables.items():
+            col = _table_config(self.args.config, 'refresh_columns',
+                                tbl_schema, tbl_name)
+            if not col:
                 continue
-            self.conn.execute(table.insert(), list(table.pending.values()))
-            table.done = table.done.union(table.pending.keys())
-            table.pending = dict()
+            target = tbl.target
+            since = target_db.connection('write').execute(
+                sa.sql.select([sa.func.max(target.c[col])])).scalar()
+            qry = sa.sql.select(tbl.projection)
+            if since is not None:
+                qry = qry.where(tbl.c[col] > since)
+            changed = [
+                row for row in self.connection('sample').execute(qry)
+                if hashable(row[key] for key in tbl.pk) in target.done
+            ]
+            logging.info("refreshing %d changed rows of %s" %
+                         (len(changed), tbl_name))
+            for row in changed:
+                self.create_row_in(row, target_db, target, replace=True)
+                if target_db.pending > self.args.buffer > 0:
+                    self.flush_targets(target_db)
 
     def create_subset_in(self, target_db):
-
-        for (tbl_name, pks) in self.args.force_rows.items():
-            if '.' in tbl_name:
-                (tbl_schema, tbl_name) = tbl_name.split('.', 1)
-            else:
-                tbl_schema = None
-            source = self.tables[(tbl_schema, tbl_name)]
-            for pk in pks:
-                source_row = source.by_pk(pk)
-                if source_row:
-                    self.create_row_in(source_row,
-                                       target_db,
-                                       source.target,
-                                       prioritized=True)
-                else:
-                    logging.warn("requested %s:%s not found in source db,"
-                                 "could not create" % (source.name, pk))
+        self.begin_snapshot(self.args.snapshot)
+        targets = [target_db] + [nested_db for (nested_db, _) in self.nested]
+        for db in targets:
+            db.begin()
+        try:
+            self._create_subset_in(target_db)
+            for db in targets:
+                db.commit()
+            _save_state(self.args.cache, self.state)
+        finally:
+            self.end_snapshot()
+
+    def copy_full_tables(self, target_db):
+        """Copy ``--full-table`` tables in one streaming pass each
+
+        Only unfiltered tables whose parents are all copied in full qualify
+        (any others go through ``create_row_in`` like sampled tables).  Their keys go
+        straight into the target's ``done`` state, so lookups of these
+        parents need no further queries.  Their children are requested as
+        any created row's are, except in tables that are taken in full
+        anyway."""
+        batch_size = self.args.buffer or 1000
+        row_added = signal(SIGNAL_ROW_ADDED)
+        copying = True
+        while copying:
+            copying = False
+            for tbl in self.tables.values():
+                target = tbl.target
+                if target.copied or not target.fetch_all:
+                    continue
+                if tbl.sample_filter is not None:
+                    continue  # filtered rows are sampled, with their parents
+                parents = [lookup['table'] for lookup in target.parent_lookups]
+                if not all(parent.copied and parent is not target
+                           for parent in parents):
+                    continue
+                logging.info("copying all rows of %s" % tbl.name)
+                child_lookups = [
+                    lookup for lookup in target.child_lookups
+                    if not lookup['table'].target.fetch_all
+                ]
+                qry = sa.sql.select(tbl.projection).execution_options(
+                    stream_results=True)
+                result = self.connection('sample').execute(qry)
+                while True:
+                    rows = result.fetchmany(batch_size)
+                    if not rows:
+                        break
+                    added = []
+                    for row in rows:
+                        row = tbl.compact(row)
+                        pks = hashable((row[key] for key in target.pk))
+                        if pks in target.done:
+                            continue  # already there from a previous run
+                        added.append(row)
+                        target.pending[pks] = row
+                        for (nested_db, _) in self.nested:
+                            nested_db.tables[(tbl.schema, tbl.name)].pending[
+                                pks] = row
+                        if row_added.receivers:
+                            row_added.send(self,
+                                           source_row=row,
+                                           target_db=target_db,
+                                           target_table=target,
+                                           prioritized=False)
+                    target.n_rows = len(target.done) + len(target.pending)
+                    self.flush_targets(target_db)
+                    for row in added:
+                        self.request_row_children(row, child_lookups, False)
+                target.copied = True
+                copying = True
+
+    def _create_subset_in(self, target_db):
+
+        if self.args.refresh:
+            self.load_existing(target_db)
+        self.copy_full_tables(target_db)
+        if self.args.refresh:
+            self.refresh_changed(target_db)
+
+        self.create_forced_rows(target_db)
 
         while True:
             targets = sorted(target_db.tables.values(),
@@ -454,6 +1875,8 @@ class Db(object):
                 while not target.source.n_rows:
                     target = targets.pop(0)
             except IndexError:  # pop failure, no more tables
+                if self.scan_all_children():
+                    continue
                 break
             logging.debug("total n_rows in target: %d" %
                           sum((t.n_rows for t in target_db.tables.values())))
@@ -462,7 +1885,11 @@ class Db(object):
             logging.info("lowest completeness score (in %s) at %f" %
                          (target.name, target.completeness_score()))
             if target.completeness_score() > 0.97:
+                if self.scan_all_children():
+                    continue
                 break
+            if self.scan_all_children(target.source):
+                continue
             (source_row, prioritized) = target.source.next_row()
             self.create_row_in(source_row,
                                target_db,
@@ -470,10 +1897,10 @@ class Db(object):
                                prioritized=prioritized)
 
             if target_db.pending > self.args.buffer > 0:
-                target_db.flush()
+                self.flush_targets(target_db)
 
         if self.args.buffer > 0:
-            target_db.flush()
+            self.flush_targets(target_db)
 
 
 def update_sequences(source, target, schemas, tables, exclude_tables):
@@ -494,6 +1921,7 @@ def update_sequences(source, target, schemas, tables, exclude_tables):
              JOIN pg_namespace n ON (n.oid=t.relnamespace)
              WHERE s.relkind='S' AND d.deptype='a'"""
 
+    transaction = target.connections['write'].begin()
     for (qry, qual_name, schema, table) in list(source.conn.execute(qry)):
         if schema not in schemas:
             continue
@@ -504,8 +1932,8 @@ def update_sequences(source, target, schemas, tables, exclude_tables):
         (lastval, ) = source.conn.execute(qry).first()
         nextval = int(lastval) + 1
         updater = "ALTER SEQUENCE %s RESTART WITH %s;" % (qual_name, nextval)
-        target.conn.execute(updater)
-    target.conn.execute('commit')
+        target.connection('write').execute(updater)
+    transaction.commit()
 
 
 def fraction(n):
@@ -543,6 +1971,14 @@ argparser.add_argument(
     'fraction',
     help='Proportion of rows to create in dest (0.0 to 1.0)',
     type=fraction)
+argparser.add_argument(
+    '--replica',
+    dest='replicas',
+    help='SQLAlchemy connection string for a read replica of the source, '
+    'to share sampling and child lookups (may be used multiple times)',
+    type=str,
+    action='append',
+    default=[])
 argparser.add_argument(
     '-l',
     '--logarithmic',
@@ -555,6 +1991,74 @@ argparser.add_argument(
     'Number of records to store in buffer before flush; use 0 for no buffer',
     type=int,
     default=1000)
+argparser.add_argument(
+    '--pool-size',
+    help='Connections to pool per database (at least one per role is kept)',
+    type=int,
+    default=5)
+argparser.add_argument(
+    '--seed',
+    help='Choose rows reproducibly, by a hash of their keys and this seed',
+    type=int)
+argparser.add_argument(
+    '--cache',
+    help='JSON file for keeping state (like sampled keys) between runs',
+    type=str)
+argparser.add_argument(
+    '--nested',
+    help='Also write a smaller subset, contained in the main one, to this '
+    'destination (may be used multiple times)',
+    nargs=2,
+    metavar=('DEST', 'FRACTION'),
+    action='append',
+    default=[])
+argparser.add_argument(
+    '--refresh',
+    help='Add to the rows already in dest, and update those changed since',
+    action='store_true')
+argparser.add_argument(
+    '--child-scan-batch',
+    help='Parents to collect before scanning a child table whose foreign '
+    'key is not indexed; use 0 to look up every parent separately',
+    type=int,
+    default=1000)
+argparser.add_argument(
+    '--parent-cache',
+    help='Number of source parent rows to cache; use 0 for no cache',
+    type=int,
+    default=10000)
+argparser.add_argument(
+    '--max-queue',
+    help='Queue at most this many requested child rows per table; '
+    '0 for no limit',
+    type=int,
+    default=0)
+argparser.add_argument(
+    '--timeout',
+    help='Cancel sampling queries and child lookups that run longer than '
+    'this many seconds, falling back to cheaper strategies; 0 for no limit',
+    type=float,
+    default=0)
+argparser.add_argument(
+    '--per-table-reflection',
+    help='On PostgreSQL, reflect each table through the SQLAlchemy '
+    'inspector instead of reading the whole catalog at once',
+    action='store_true',
+    default=False)
+argparser.add_argument(
+    '--commit-rows',
+    help='Commit the destination transaction every N rows; 0 for no limit',
+    type=int,
+    default=10000)
+argparser.add_argument(
+    '--commit-seconds',
+    help='Commit the destination transaction every N seconds; 0 for no limit',
+    type=float,
+    default=60)
+argparser.add_argument(
+    '--snapshot',
+    help='Exported PostgreSQL snapshot id to read the source in',
+    type=str)
 argparser.add_argument('--loglevel',
                        type=loglevel,
                        help='log level (%s)' % all_loglevels,
@@ -610,6 +2114,11 @@ argparser.add_argument(
     type=str,
     action='append',
     default=[])
+argparser.add_argument(
+    '--budget',
+    help='Size (like 500MB) the subset should stay within; if the estimate '
+    'exceeds it, smaller --children and fraction values are suggested',
+    type=planner.size)
 argparser.add_argument('-y',
                        '--yes',
                        help='Proceed without stopping for confirmation',
@@ -623,29 +2132,172 @@ def merge_config_args(args):
     args.schema.extend(args.config.get("schemas", []))
     args.full_tables.extend(args.config.get("full_tables", []))
 
+def _force_rows(force, force_rows=None):
+    """Add ``<table name>:<primary_key_val>`` strings from ``--force`` to a
+    ``{table name: [primary key values]}`` dict"""
+    force_rows = {} if force_rows is None else force_rows
+    for force_row in (force or []):
+        (table_name, pk) = force_row.split(':')
+        if table_name not in force_rows:
+            force_rows[table_name] = []
+        force_rows[table_name].append(pk)
+    return force_rows
+
+
+# ``Subsetter`` options that are fixed once the databases are reflected
+REFLECTION_OPTIONS = ('config', 'schema', 'tables', 'exclude_tables',
+                      'full_tables', 'replicas', 'per_table_reflection',
+                      'pool_size', 'import_list')
+
+
+def _default_args(fraction):
+    """The command line's option defaults, with ``fraction``, as the
+    ``args`` of a ``Subsetter``"""
+    args = argparse.Namespace(fraction=fraction, force_rows={})
+    for action in argparser._actions:
+        if action.dest in ('help', 'source', 'dest', 'fraction'):
+            continue
+        default = argparser.get_default(action.dest)
+        if isinstance(default, list):  # not the parser's own list
+            default = list(default)
+        setattr(args, action.dest, default)
+    return args
+
+
+def _set_options(args, options):
+    for (name, value) in options.items():
+        if name != 'force_rows' and not hasattr(args, name):
+            raise TypeError("unknown option '%s'" % name)
+        setattr(args, name, value)
+    if 'force' in options:
+        args.force_rows = _force_rows(options['force'],
+                                      dict(args.force_rows))
+
+
+class Subsetter(object):
+    """
+    Write subsets of one source database from Python, e.g. in test fixtures::
+
+        subsetter = Subsetter(engine, 0.05, children=2)
+        stats = subsetter.subset('sqlite:///subset.db')
+        stats = subsetter.subset(other_engine, fraction=0.01)
+
+    Databases are connection strings, ``Engine`` objects or ``Connection``
+    objects (used within whatever transaction they are in).  Other options
+    are the command line's, as keyword arguments named like its
+    destinations (``full_tables``, ``exclude_tables``, ``config`` as a dict,
+    ``force_rows`` as ``{table name: [primary key values]}``, ...).
+
+    Each database is reflected once, by the first call that uses it (or any
+    ``Connection`` of its engine); later calls only count its rows again.  ``subset`` options override the
+    constructor's for that call, except for ``REFLECTION_OPTIONS``.
+    """
+
+    def __init__(self, source, fraction, **options):
+        self.source = source
+        self.args = _default_args(fraction)
+        _set_options(self.args, options)
+        self.args.config = self.args.config or {}
+        _import_modules(self.args.import_list)
+        merge_config_args(self.args)
+        self.schemas = self.args.schema + [None, ]
+        self.databases = {}
+
+    def db(self, sqla_conn, args, replicas=[]):
+        """The ``Db`` for ``sqla_conn``, reflected on first use
+
+        ``Connection`` objects are told apart by their engine, so that each
+        call can work within a new one (say, the transaction of a test
+        fixture) without reflecting the database again."""
+        key = sqla_conn
+        if isinstance(sqla_conn, sa.engine.Connection):
+            key = ('connection', sqla_conn.engine)
+        db = self.databases.get(key)
+        if db is None:
+            db = Db(sqla_conn, args, self.schemas, replicas=replicas)
+            self.databases[key] = db
+        else:
+            if db.shared_connection and db.sqla_conn is not sqla_conn:
+                db.rebind(sqla_conn)
+            db.args = args
+            db.count_rows()
+        return db
+
+    def subset(self, dest, **options):
+        """
+        Write a subset of the source to ``dest``
+
+        Returns ``{'tables': {name: rows}, 'rows': n, 'seconds': s}``, with
+        the rows in each table of ``dest`` once the subset is written.
+        """
+        started = time.time()
+        fixed = sorted(set(options) & set(REFLECTION_OPTIONS))
+        if fixed:
+            raise TypeError("%s can only be given to Subsetter()" %
+                            ', '.join(fixed))
+        args = argparse.Namespace(**vars(self.args))
+        _set_options(args, options)
+        source = self.db(self.source, args, replicas=args.replicas)
+        target = self.db(dest, args)
+        if set(source.tables.keys()) != set(target.tables.keys()):
+            raise Exception('Source and target databases have different '
+                            'tables')
+        source.assign_target(target)
+        nested = []
+        for (nested_dest, nested_fraction) in args.nested:
+            nested_db = self.db(nested_dest, args)
+            if set(source.tables.keys()) != set(nested_db.tables.keys()):
+                raise Exception('Source and nested target databases have '
+                                'different tables')
+            nested.append((nested_db, fraction(nested_fraction)))
+        source.assign_nested_targets(nested)
+        source.create_subset_in(target)
+        for db in [target] + [nested_db for (nested_db, _) in nested]:
+            update_sequences(source, db, self.schemas, args.tables,
+                             args.exclude_tables)
+        tables = OrderedDict(
+            ('.'.join(part for part in key if part), tbl.n_rows)
+            for (key, tbl) in target.tables.items())
+        return {
+            'tables': tables,
+            'rows': sum(tables.values()),
+            'seconds': time.time() - started,
+        }
+
+    def close(self):
+        for db in self.databases.values():
+            db.close()
+        self.databases = {}
+
+
 def generate():
     args = argparser.parse_args()
     _import_modules(args.import_list)
-    args.force_rows = {}
-    for force_row in (args.force or []):
-        (table_name, pk) = force_row.split(':')
-        if table_name not in args.force_rows:
-            args.force_rows[table_name] = []
-        args.force_rows[table_name].append(pk)
+    args.force_rows = _force_rows(args.force)
     logging.getLogger().setLevel(args.loglevel)
     logging.basicConfig(format=log_format)
 
     args.config = json.load(args.config) if args.config else {}
     merge_config_args(args)
     schemas = args.schema + [None, ]
-    source = Db(args.source, args, schemas)
+    source = Db(args.source, args, schemas, replicas=args.replicas)
     target = Db(args.dest, args, schemas)
     if set(source.tables.keys()) != set(target.tables.keys()):
         raise Exception('Source and target databases have different tables')
     source.assign_target(target)
+    nested = []
+    for (nested_dest, nested_fraction) in args.nested:
+        nested_db = Db(nested_dest, args, schemas)
+        if set(source.tables.keys()) != set(nested_db.tables.keys()):
+            raise Exception('Source and nested target databases have '
+                            'different tables')
+        nested.append((nested_db, fraction(nested_fraction)))
+    source.assign_nested_targets(nested)
     if source.confirm():
         source.create_subset_in(target)
-    update_sequences(source, target, schemas, args.tables, args.exclude_tables)
+    for db in [target] + [nested_db for (nested_db, _) in nested]:
+        update_sequences(source, db, schemas, args.tables,
+                         args.exclude_tables)
 
 
 def hashable(raw):
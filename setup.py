@@ -35,14 +35,13 @@ setup(
         "blinker",
         "sqlalchemy",
     ],
+    python_requires='>=3.4',
     license="CC0",
     keywords='database testing',
     classifiers=[
         'Development Status :: 3 - Alpha',
         'License :: CC0 1.0 Universal (CC0 1.0) Public Domain Dedication',
         'Natural Language :: English',
-        'Programming Language :: Python :: 2',
-        'Programming Language :: Python :: 2.7',
         'Programming Language :: Python :: 3',
         'Programming Language :: Python :: 3.4',
         'Topic :: Database',
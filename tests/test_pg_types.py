@@ -9,6 +9,7 @@ import pytest_postgresql
 from pytest_postgresql import factories
 
 from rdbms_subsetter.subsetter import Db
+from test_subsetter import DummyArgs
 
 try:
     subprocess.check_output('command -v pg_ctl', shell=True)
@@ -20,19 +21,6 @@ postgresql_dest_proc = factories.postgresql_proc()
 postgresql_dest = factories.postgresql('postgresql_dest_proc')
 
 
-class DummyArgs(object):
-    logarithmic = False
-    fraction = 0.25
-    force_rows = {}
-    children = 25
-    config = {}
-    tables = []
-    schema = []
-    exclude_tables = []
-    full_tables = []
-    buffer = 1000
-
-
 dummy_args = DummyArgs()
 
 
@@ -141,3 +129,19 @@ def test_array_of_enums(pg_data):
     dest_curs.execute("SELECT * FROM moody_cat")
     cats = dest_curs.fetchall()
     assert len(cats) == 1
+
+@pytest.mark.skipif(PG_CTL_MISSING, reason='PostgreSQL not installed locally')
+def test_catalog_reflection_matches_inspector(pg_data):
+    args = DummyArgs()
+    catalog_db = Db(pg_data[0], args)
+    args.per_table_reflection = True
+    inspector_db = Db(pg_data[0], args)
+    assert list(catalog_db.tables) == list(inspector_db.tables)
+    for (key, tbl) in catalog_db.tables.items():
+        other = inspector_db.tables[key]
+        assert [c.name for c in tbl.c] == [c.name for c in other.c]
+        assert [str(c.type) for c in tbl.c] == [str(c.type) for c in other.c]
+        assert tbl.pk == other.pk
+        assert tbl.fks == other.fks
+    possible_moods = catalog_db.tables[(None, 'moody_cat')].c.possible_moods
+    assert possible_moods.type.__class__.__name__ == 'ArrayOfEnum'
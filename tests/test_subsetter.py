@@ -2,13 +2,24 @@
 # -*- coding: utf-8 -*-
 """Tests for `sql_insert_writer` package."""
 
+import json
 import os
+import random
+import shutil
 import sqlite3
 import tempfile
+import time
 
 import pytest
+import sqlalchemy as sa
+from blinker import signal
+from sqlalchemy.dialects.postgresql import ARRAY, ENUM
 
-from rdbms_subsetter.subsetter import Db
+from dialects.postgres import build_tables
+
+from rdbms_subsetter import Subsetter, planner, subsetter
+from rdbms_subsetter.subsetter import (CONNECTION_ROLES, SIGNAL_ROWS_FLUSHED,
+                                       Db, RowBatch, _Row, _RowCache)
 
 TABLE_DEFINITIONS = [
     "CREATE TABLE state (abbrev, name)",
@@ -37,6 +48,19 @@ class DummyArgs(object):
     exclude_tables = []
     full_tables = []
     buffer = 1000
+    pool_size = 5
+    budget = None
+    child_scan_batch = 1000
+    refresh = False
+    seed = None
+    cache = None
+    parent_cache = 10000
+    commit_rows = 10000
+    commit_seconds = 60
+    snapshot = None
+    per_table_reflection = False
+    timeout = 0
+    max_queue = 0
 
 
 dummy_args = DummyArgs()
@@ -181,3 +205,807 @@ def test_exclude_tables_wildcard(sqlite_data):
     assert not zeppelins
     zeppos = dest_curs.execute("SELECT * FROM zeppos").fetchall()
     assert not zeppos
+
+
+def test_connection_per_role(sqlite_data):
+    (src, dest) = results(*sqlite_data, dummy_args)
+    conns = [src.connections[role] for role in CONNECTION_ROLES] + [src.conn]
+    assert len(set(id(conn) for conn in conns)) == len(conns)
+    src.close()
+    assert all(conn.closed for conn in conns)
+
+
+def test_commit_interval(sqlite_data):
+    args_with_commits = DummyArgs()
+    args_with_commits.buffer = 0
+    args_with_commits.commit_rows = 1
+    (src, dest) = results(*sqlite_data, args_with_commits)
+    assert dest.transaction is None
+    dest_curs = sqlite3.connect(dest.engine.url.database).cursor()
+    cities = dest_curs.execute("SELECT * FROM city").fetchall()
+    assert len(cities) == 1
+
+
+def test_lookups_compiled_once(sqlite_data):
+    (src, dest) = results(*sqlite_data, dummy_args)
+    lookup = dest.tables[(None, 'city')].parent_lookups[0]
+    cache = src.engine.get_execution_options()['compiled_cache']
+    assert any(key[1] is lookup['source_query'] for key in cache)
+
+
+def test_parent_rows_cached(sqlite_data):
+    args_with_cache = DummyArgs()
+    args_with_cache.parent_cache = 1
+    (src, dest) = results(*sqlite_data, args_with_cache)
+    assert len(src.parent_cache.rows) == 1
+    ((schema, table, columns, values), row) = src.parent_cache.rows.popitem()
+    assert (table, columns) in (('state', ('abbrev', )), ('city', ('name', )))
+    assert row[columns[0]] == values[0]
+
+
+def test_row_cache_evicts_least_recently_used():
+    cache = _RowCache(2)
+    queries = []
+
+    def query(row):
+        return lambda: queries.append(row) or row
+
+    cache.fetch('a', query('A'))
+    cache.fetch('b', query(None))  # misses are cached too
+    cache.fetch('a', query('A'))
+    cache.fetch('c', query('C'))  # evicts 'b'
+    assert cache.fetch('b', query(None)) is None
+    assert queries == ['A', None, 'C', None]
+
+
+def test_full_tables_copied_in_bulk(sqlite_data):
+    args_with_full = DummyArgs()
+    args_with_full.full_tables = ['state', ]
+    (src, dest) = results(*sqlite_data, args_with_full)
+    assert dest.tables[(None, 'state')].copied
+    assert not dest.tables[(None, 'city')].copied
+    assert not any(key[1] == 'state' for key in src.parent_cache.rows)
+    dest_curs = dest.conn.connection.cursor()
+    states = dest_curs.execute("SELECT * FROM state").fetchall()
+    assert len(states) == 4
+    # copied states still request their children, as sampled rows do
+    cities = dest_curs.execute("SELECT * FROM city").fetchall()
+    assert len(cities) == 3
+
+
+def empty_copy():
+    """Creates another empty destination database; returns its url"""
+    (filename, db) = temp_sqlite_db()
+    for table_def in TABLE_DEFINITIONS:
+        db.execute(table_def)
+    db.commit()
+    db.close()
+    return sqla_url(filename)
+
+
+def test_seeded_sample_is_reproducible(sqlite_data):
+    (src_url, dest_url) = sqlite_data
+    args_with_seed = DummyArgs()
+    args_with_seed.seed = 42
+    args_with_seed.cache = tempfile.mktemp()
+    contents = []
+    for url in (dest_url, empty_copy(), empty_copy()):
+        (src, dest) = results(src_url, url, args_with_seed)
+        dest_curs = dest.conn.connection.cursor()
+        contents.append([
+            dest_curs.execute("SELECT * FROM %s ORDER BY 1" % table).fetchall()
+            for table in ('state', 'city', 'landmark', 'zeppelins')
+        ])
+    assert contents[0] == contents[1] == contents[2]
+    with open(args_with_seed.cache) as cache:
+        samples = json.load(cache)['samples']
+    assert samples['zeppos']['seed'] == 42
+    assert samples['zeppos']['keys'] == [['Zeppo Marx', 'New York City']]
+    os.unlink(args_with_seed.cache)
+
+
+def test_seeded_child_lookups_take_children_by_key():
+    (source_filename, source_db) = temp_sqlite_db()
+    (dest_filename, dest_db) = temp_sqlite_db()
+    for db in (source_db, dest_db):
+        db.execute("CREATE TABLE author (id INTEGER PRIMARY KEY, name)")
+        db.execute("""CREATE TABLE book (id TEXT PRIMARY KEY, author_id,
+                      FOREIGN KEY (author_id) REFERENCES author(id))""")
+        db.execute("CREATE INDEX book_author ON book (author_id)")
+    source_db.execute("INSERT INTO author VALUES (1, 'Austen')")
+    for book_id in ('c', 'b', 'a'):  # stored out of key order
+        source_db.execute("INSERT INTO book VALUES (?, 1)", (book_id, ))
+    source_db.commit()
+    args_with_seed = DummyArgs()
+    args_with_seed.seed = 42
+    args_with_seed.children = 1
+    src = Db(sqla_url(source_filename), args_with_seed)
+    dest = Db(sqla_url(dest_filename), args_with_seed)
+    src.assign_target(dest)
+    author = src.tables[(None, 'author')]
+    row = src.conn.execute(author.select()).first()
+    src.create_row_in(row, dest, author.target)
+    assert list(src.tables[(None, 'book')].target.requested) == [('a', )]
+    os.unlink(source_filename)
+    os.unlink(dest_filename)
+
+
+def test_refresh_copies_changed_rows():
+    (source_filename, source_db) = temp_sqlite_db()
+    (dest_filename, dest_db) = temp_sqlite_db()
+    for db in (source_db, dest_db):
+        db.execute("CREATE TABLE item (id INTEGER PRIMARY KEY, label, updated)")
+    for params in ((1, 'one', 1), (2, 'two', 1), (3, 'three', 1)):
+        source_db.execute("INSERT INTO item VALUES (?, ?, ?)", params)
+    source_db.commit()
+    args = DummyArgs()
+    args.fraction = 1.0
+    results(sqla_url(source_filename), sqla_url(dest_filename), args)
+
+    source_db.execute("UPDATE item SET label = 'uno', updated = 2 WHERE id = 1")
+    source_db.execute("INSERT INTO item VALUES (4, 'four', 2)")
+    source_db.commit()
+    args_with_refresh = DummyArgs()
+    args_with_refresh.fraction = 0.25
+    args_with_refresh.refresh = True
+    args_with_refresh.config = {'refresh_columns': {'item': 'updated'}}
+    (src, dest) = results(sqla_url(source_filename), sqla_url(dest_filename),
+                          args_with_refresh)
+    items = dest_db.execute("SELECT id, label FROM item ORDER BY id").fetchall()
+    # the new row isn't needed for a quarter of the source
+    assert items == [(1, 'uno'), (2, 'two'), (3, 'three')]
+
+
+def test_refresh_leaves_changed_rows_outside_subset_out():
+    (source_filename, source_db) = temp_sqlite_db()
+    (dest_filename, dest_db) = temp_sqlite_db()
+    for db in (source_db, dest_db):
+        db.execute("CREATE TABLE item (id INTEGER PRIMARY KEY, label, updated)")
+    for item_id in range(20):
+        source_db.execute("INSERT INTO item VALUES (?, 'old', 1)",
+                          (item_id, ))
+    source_db.commit()
+    args_with_refresh = DummyArgs()
+    args_with_refresh.config = {'refresh_columns': {'item': 'updated'}}
+    results(sqla_url(source_filename), sqla_url(dest_filename),
+            args_with_refresh)
+    subset = [row[0] for row in dest_db.execute("SELECT id FROM item")]
+    assert len(subset) == 5
+
+    source_db.execute("UPDATE item SET label = 'new', updated = 2")
+    source_db.commit()
+    args_with_refresh.refresh = True
+    results(sqla_url(source_filename), sqla_url(dest_filename),
+            args_with_refresh)
+    items = dest_db.execute("SELECT id, label FROM item").fetchall()
+    assert sorted(items) == [(item_id, 'new') for item_id in sorted(subset)]
+    os.unlink(source_filename)
+    os.unlink(dest_filename)
+
+
+def test_unindexed_children_scanned_in_batches(sqlite_data):
+    (src_url, dest_url) = sqlite_data
+    source_db = sqlite3.connect(src_url[len('sqlite:///'):])
+    source_db.execute("CREATE INDEX city_state ON city (state_abbrev)")
+    source_db.close()
+    args_with_scans = DummyArgs()
+    args_with_scans.fraction = 1.0
+    (src, dest) = results(src_url, dest_url, args_with_scans)
+    [city_lookup] = dest.tables[(None, 'state')].child_lookups
+    [landmark_lookup] = [
+        lookup for lookup in dest.tables[(None, 'city')].child_lookups
+        if lookup['table'].name == 'landmark'
+    ]
+    assert not city_lookup['batched']
+    assert landmark_lookup['batched']
+    assert not landmark_lookup['parents']
+    dest_curs = dest.conn.connection.cursor()
+    landmarks = dest_curs.execute("SELECT * FROM landmark").fetchall()
+    assert len(landmarks) == 4
+
+
+def test_child_scans_wait_for_whole_batches(monkeypatch):
+    (source_filename, source_db) = temp_sqlite_db()
+    (dest_filename, dest_db) = temp_sqlite_db()
+    for db in (source_db, dest_db):
+        db.execute("CREATE TABLE city (id INTEGER PRIMARY KEY, name)")
+        db.execute("""CREATE TABLE person (id INTEGER PRIMARY KEY, city_id,
+                      boss_id,
+                      FOREIGN KEY (city_id) REFERENCES city(id),
+                      FOREIGN KEY (boss_id) REFERENCES person(id))""")
+    for city_id in range(100):
+        source_db.execute("INSERT INTO city VALUES (?, 'c')", (city_id, ))
+    for person_id in range(1000):
+        source_db.execute("INSERT INTO person VALUES (?, ?, ?)",
+                          (person_id, person_id % 100, person_id // 3 or None))
+    source_db.commit()
+    scans = []
+    scan_children = Db.scan_children
+
+    def count_parents(self, lookup):
+        scans.append(len(lookup['parents']))
+        scan_children(self, lookup)
+
+    monkeypatch.setattr(Db, 'scan_children', count_parents)
+    args_with_scans = DummyArgs()
+    args_with_scans.fraction = 0.1
+    results(sqla_url(source_filename), sqla_url(dest_filename),
+            args_with_scans)
+    assert sum(scans) >= 100
+    assert sum(scans) / len(scans) >= 10  # not one scan per parent or two
+    os.unlink(source_filename)
+    os.unlink(dest_filename)
+
+
+def test_confirm_estimates_subset(sqlite_data, capsys):
+    args_with_budget = DummyArgs()
+    args_with_budget.yes = True
+    args_with_budget.fraction = 0.5
+    args_with_budget.budget = 200
+    src = Db(sqlite_data[0], args_with_budget)
+    dest = Db(sqlite_data[1], args_with_budget)
+    src.assign_target(dest)
+    assert src.confirm()
+    out = capsys.readouterr().out
+    assert "Create 2 rows from 4 in .city (estimated 2 rows" in out
+    assert "Estimated total: 9 rows" in out
+    assert "--children=1 with fraction" in out
+
+
+def test_estimate_follows_real_subset():
+    (source_filename, source_db) = temp_sqlite_db()
+    (dest_filename, dest_db) = temp_sqlite_db()
+    for db in (source_db, dest_db):
+        db.execute("CREATE TABLE region (id INTEGER PRIMARY KEY)")
+        db.execute("""CREATE TABLE city (id INTEGER PRIMARY KEY, region_id,
+                      FOREIGN KEY (region_id) REFERENCES region(id))""")
+        db.execute("""CREATE TABLE person (id INTEGER PRIMARY KEY, city_id,
+                      boss_id,
+                      FOREIGN KEY (city_id) REFERENCES city(id),
+                      FOREIGN KEY (boss_id) REFERENCES person(id))""")
+    for region_id in range(20):
+        source_db.execute("INSERT INTO region VALUES (?)", (region_id, ))
+    for city_id in range(400):
+        source_db.execute("INSERT INTO city VALUES (?, ?)",
+                          (city_id, city_id * 7 % 20))
+    rng = random.Random(1)
+    for person_id in range(2000):
+        source_db.execute("INSERT INTO person VALUES (?, ?, ?)",
+                          (person_id, rng.randrange(400),
+                           rng.randrange(person_id) if person_id else None))
+    source_db.commit()
+    args = DummyArgs()
+    args.children = 3
+    args.fraction = 0.05
+    args.seed = 1
+    src = Db(sqla_url(source_filename), args)
+    dest = Db(sqla_url(dest_filename), args)
+    src.assign_target(dest)
+    plan = planner.estimate(
+        src, dict((key, tbl.target.n_rows_desired)
+                  for (key, tbl) in src.tables.items()), args.children, {})
+    src.create_subset_in(dest)
+    for (key, tbl) in dest.tables.items():
+        assert tbl.n_rows / 1.5 <= plan[key]['rows'] <= tbl.n_rows * 1.5
+    os.unlink(source_filename)
+    os.unlink(dest_filename)
+
+
+def test_nested_targets(sqlite_data):
+    (src_url, dest_url) = sqlite_data
+    args_with_nested = DummyArgs()
+    args_with_nested.fraction = 1.0
+    src = Db(src_url, args_with_nested)
+    dest = Db(dest_url, args_with_nested)
+    nested = Db(empty_copy(), args_with_nested)
+    src.assign_target(dest)
+    src.assign_nested_targets([(nested, 0.5)])
+    src.create_subset_in(dest)
+    dest_curs = dest.conn.connection.cursor()
+    nested_curs = nested.conn.connection.cursor()
+    for table in ('state', 'city', 'landmark', 'zeppelins', 'zeppos'):
+        qry = "SELECT * FROM %s" % table
+        dest_rows = set(dest_curs.execute(qry).fetchall())
+        nested_rows = set(nested_curs.execute(qry).fetchall())
+        assert nested_rows <= dest_rows
+        assert len(nested_rows) < len(dest_rows) or len(dest_rows) < 2
+    orphans = nested_curs.execute("""SELECT * FROM landmark l
+                                     LEFT JOIN city c ON (l.city = c.name)
+                                     LEFT JOIN state s
+                                     ON (c.state_abbrev = s.abbrev)
+                                     WHERE s.abbrev IS NULL""").fetchall()
+    assert not orphans
+    assert nested_curs.execute("SELECT * FROM landmark").fetchall()
+
+
+def test_nested_shares_follow_logarithmic_fractions():
+    (source_filename, source_db) = temp_sqlite_db()
+    (dest_filename, dest_db) = temp_sqlite_db()
+    (nested_filename, nested_db) = temp_sqlite_db()
+    for db in (source_db, dest_db, nested_db):
+        db.execute("CREATE TABLE item (id INTEGER PRIMARY KEY)")
+    source_db.executemany("INSERT INTO item VALUES (?)",
+                          ((item_id, ) for item_id in range(10000)))
+    source_db.commit()
+    args_with_log = DummyArgs()
+    args_with_log.logarithmic = True
+    args_with_log.fraction = 0.5
+    src = Db(sqla_url(source_filename), args_with_log)
+    dest = Db(sqla_url(dest_filename), args_with_log)
+    nested = Db(sqla_url(nested_filename), args_with_log)
+    src.assign_target(dest)
+    src.assign_nested_targets([(nested, 0.25)])
+    item = src.tables[(None, 'item')]
+    assert item.target.n_rows_desired == 100
+    assert item.nested_shares == [0.1]  # 10 of the 100 rows, not half
+    for filename in (source_filename, dest_filename, nested_filename):
+        os.unlink(filename)
+
+
+def test_replicas_share_the_reads(sqlite_data):
+    (src_url, dest_url) = sqlite_data
+    replicas = []
+    for _ in range(2):
+        filename = tempfile.mktemp()
+        shutil.copy(src_url[len('sqlite:///'):], filename)
+        replicas.append(sqla_url(filename))
+    src = Db(src_url, dummy_args, replicas=replicas)
+    dest = Db(dest_url, dummy_args)
+    queries = []
+    for replica in src.replicas:
+        sa.event.listen(replica, 'before_cursor_execute',
+                        lambda *args, **kw: queries.append(args[0].engine))
+    src.assign_target(dest)
+    src.create_subset_in(dest)
+    assert set(queries) == set(src.replicas)
+    dest_curs = dest.conn.connection.cursor()
+    cities = dest_curs.execute("SELECT * FROM city").fetchall()
+    assert len(cities) == 1
+
+
+def test_buffered_rows_are_compact(sqlite_data):
+    (src_url, dest_url) = sqlite_data
+    src = Db(src_url, dummy_args)
+    dest = Db(dest_url, dummy_args)
+    src.assign_target(dest)
+    city = src.tables[(None, 'city')]
+    row = src.conn.execute(city.select()).first()
+    src.create_row_in(row, dest, city.target)
+    (pending, ) = dest.tables[(None, 'city')].pending.values()
+    assert isinstance(pending, _Row)
+    assert not hasattr(pending, '__dict__')
+    assert pending['state_abbrev'] == row['state_abbrev']
+    assert pending[city.c.state_abbrev] == pending.state_abbrev == row[
+        'state_abbrev']
+    with pytest.raises(AttributeError):
+        pending.population
+    assert dest.tables[(None, 'state')].pending
+    dest.flush()
+    dest_curs = dest.conn.connection.cursor()
+    assert dest_curs.execute("SELECT * FROM city").fetchall() == [tuple(row)]
+
+
+def test_rows_flushed_signal_transforms_batches(sqlite_data):
+    batches = []
+
+    def mask_names(target_db, target_table, batch):
+        batches.append((target_table.name, len(batch)))
+        batch.set_column('name', [name.upper()
+                                  for name in batch.column('name')])
+
+    rows_flushed = signal(SIGNAL_ROWS_FLUSHED)
+    rows_flushed.connect(mask_names)
+    try:
+        (src, dest) = results(*sqlite_data, dummy_args)
+    finally:
+        rows_flushed.disconnect(mask_names)
+    assert ('city', 1) in batches
+    dest_curs = dest.conn.connection.cursor()
+    states = dest_curs.execute("SELECT name FROM state").fetchall()
+    assert states and all(name == name.upper() for (name, ) in states)
+
+
+def test_rows_flushed_handlers_keep_rows():
+    (source_filename, source_db) = temp_sqlite_db()
+    (dest_filename, dest_db) = temp_sqlite_db()
+    for db in (source_db, dest_db):
+        db.execute("CREATE TABLE item (id INTEGER PRIMARY KEY, label)")
+    for item_id in range(6):
+        source_db.execute("INSERT INTO item VALUES (?, 'old')", (item_id, ))
+    source_db.commit()
+
+    def reverse_rows(target_db, target_table, batch):
+        batch.rows = reversed(batch.rows)
+
+    def drop_rows(target_db, target_table, batch):
+        batch.rows = [row for row in batch.rows if row[0] % 2 == 0]
+
+    args = DummyArgs()
+    args.fraction = 1.0
+    rows_flushed = signal(SIGNAL_ROWS_FLUSHED)
+    rows_flushed.connect(reverse_rows)
+    try:
+        (src, dest) = results(sqla_url(source_filename),
+                              sqla_url(dest_filename), args)
+        item = dest.tables[(None, 'item')]
+        # as dialects without an upsert overwrite rows
+        item.upserter = item.update().where(
+            item.c.id == sa.bindparam('key_0'))
+        dest.replace(item, dict(((item_id, ),
+                                 item.source.row_type((item_id, str(item_id))))
+                                for item_id in range(6)))
+    finally:
+        rows_flushed.disconnect(reverse_rows)
+    items = dest_db.execute("SELECT * FROM item ORDER BY id").fetchall()
+    assert items == [(item_id, str(item_id)) for item_id in range(6)]
+
+    rows_flushed.connect(drop_rows)
+    try:
+        with pytest.raises(Exception, match='must not add, drop or rekey'):
+            dest.replace(item, dict(((item_id, ),
+                                     item.source.row_type((item_id, 'new')))
+                                    for item_id in range(6)))
+    finally:
+        rows_flushed.disconnect(drop_rows)
+    os.unlink(source_filename)
+    os.unlink(dest_filename)
+
+
+def test_row_batch_rows_and_columns():
+    batch = RowBatch(['abbrev', 'name'], [('MN', 'Minnesota'), ('OH', 'Ohio')])
+    batch.column('name')[1] = 'Buckeye'
+    assert batch.rows == [('MN', 'Minnesota'), ('OH', 'Buckeye')]
+    batch.rows = [row for row in batch.rows if row[0] != 'MN']
+    batch.set_column('abbrev', ['XX'])
+    assert batch.params() == [{'abbrev': 'XX', 'name': 'Buckeye'}]
+    with pytest.raises(ValueError):
+        batch.set_column('name', [])
+
+
+def test_forced_rows_from_config(sqlite_data):
+    keys_file = tempfile.NamedTemporaryFile('w', suffix='.csv', delete=False)
+    keys_file.write('MA\nMI\n')
+    keys_file.close()
+    args_with_force = DummyArgs()
+    args_with_force.config = {
+        'force': {
+            'city': {'where': "state_abbrev IN ('MN', 'OH')"},
+            'state': {'keys_file': keys_file.name},
+        }
+    }
+    try:
+        (src, dest) = results(*sqlite_data, args_with_force)
+    finally:
+        os.unlink(keys_file.name)
+    assert (None, 'state', ('abbrev', ), ('MN', )) in src.parent_cache.rows
+    dest_curs = dest.conn.connection.cursor()
+    states = dest_curs.execute("SELECT abbrev FROM state").fetchall()
+    assert sorted(states) == [('MA', ), ('MI', ), ('MN', ), ('OH', )]
+    landmarks = dest_curs.execute("SELECT city FROM landmark").fetchall()
+    assert ('Duluth', ) in landmarks and ('Dayton', ) in landmarks
+
+
+def test_forced_rows_must_name_tables_and_whole_keys(sqlite_data):
+    (src_url, dest_url) = sqlite_data
+    args_with_typo = DummyArgs()
+    args_with_typo.force_rows = {'nosuch': ['1']}
+    src = Db(src_url, args_with_typo)
+    dest = Db(dest_url, args_with_typo)
+    src.assign_target(dest)
+    with pytest.raises(Exception, match='nosuch'):
+        list(src.forced_rows())
+
+    keys_file = tempfile.NamedTemporaryFile('w', suffix='.csv', delete=False)
+    keys_file.write('MA\nMI,Michigan\n')
+    keys_file.close()
+    args_with_keys = DummyArgs()
+    args_with_keys.config = {'force': {'state': {'keys_file': keys_file.name}}}
+    src = Db(src_url, args_with_keys)
+    dest = Db(dest_url, args_with_keys)
+    src.assign_target(dest)
+    with pytest.raises(Exception, match='must each have 1 column'):
+        list(src.forced_rows())
+    os.unlink(keys_file.name)
+
+
+def test_timed_out_sampling_falls_back(sqlite_data, monkeypatch):
+    monkeypatch.setattr(subsetter, 'SQLITE_PROGRESS_STEPS', 1)
+    (src_url, dest_url) = sqlite_data
+    args_with_timeout = DummyArgs()
+    args_with_timeout.timeout = 0.05
+    args_with_timeout.cache = tempfile.mktemp()
+
+    def slow_random():
+        time.sleep(0.03)
+        return 0
+
+    src = Db(src_url, args_with_timeout)
+    dest = Db(dest_url, args_with_timeout)
+    for conn in src.connections.values():
+        conn.connection.create_function('random', 0, slow_random)
+    src.assign_target(dest)
+    src.create_subset_in(dest)
+    dest_curs = dest.conn.connection.cursor()
+    assert len(dest_curs.execute("SELECT * FROM city").fetchall()) == 1
+    with open(args_with_timeout.cache) as infile:
+        recorded = json.load(infile)['strategies']['sample']
+    assert recorded and set(recorded.values()) == set(['keyset'])
+    src.assign_target(dest)  # a later run starts with the recorded strategy
+    os.unlink(args_with_timeout.cache)
+    for name in recorded:
+        tbl = src.tables[(None, name)]
+        assert subsetter._sample_strategies(tbl) == ['keyset', 'scan']
+
+
+def test_timeout_only_limits_guarded_queries(sqlite_data, monkeypatch):
+    monkeypatch.setattr(subsetter, 'SQLITE_PROGRESS_STEPS', 1)
+    args_with_timeout = DummyArgs()
+    args_with_timeout.timeout = 0.05
+
+    def slow():
+        time.sleep(0.03)
+        return 0
+
+    src = Db(sqlite_data[0], args_with_timeout)
+    conn = src.connections['sample']
+    conn.connection.create_function('slow', 0, slow)
+    qry = sa.select([sa.func.slow()]).select_from(src.tables[(None, 'city')])
+    with pytest.raises(sa.exc.OperationalError):
+        src.guarded_fetch('sample', qry)
+    assert len(conn.execute(qry).fetchall()) == 4  # counts, copies, writes
+
+
+def test_columns_excluded_truncated_and_replaced(sqlite_data):
+    args_with_columns = DummyArgs()
+    args_with_columns.config = {
+        'columns': {
+            'state': {'truncate': {'name': 4}},
+            'landmark': {'replace': {'name': 'Somewhere'}},
+            'zeppelins': {'exclude': ['name']},
+        }
+    }
+    (src, dest) = results(*sqlite_data, args_with_columns)
+    assert src.tables[(None, 'landmark')].pk == ['city']
+    lookup = dest.tables[(None, 'city')].parent_lookups[0]
+    assert [col.name for col in lookup['target_query'].columns] == ['abbrev']
+    dest_curs = dest.conn.connection.cursor()
+    states = dest_curs.execute("SELECT name FROM state").fetchall()
+    assert states and all(len(name) <= 4 for (name, ) in states)
+    landmarks = dest_curs.execute("SELECT name FROM landmark").fetchall()
+    assert set(landmarks) <= set([('Somewhere', )])
+    zeppelins = dest_curs.execute("SELECT name FROM zeppelins").fetchall()
+    assert zeppelins == [(None, )]
+
+
+def test_key_columns_can_not_be_excluded(sqlite_data):
+    args_with_columns = DummyArgs()
+    args_with_columns.config = {'columns': {'city': {'exclude': ['name']}}}
+    with pytest.raises(Exception) as excinfo:
+        Db(sqlite_data[0], args_with_columns)
+    assert 'Key column' in str(excinfo.value)
+
+
+def test_filtered_sample(sqlite_data):
+    args_with_filter = DummyArgs()
+    args_with_filter.fraction = 1
+    args_with_filter.config = {
+        'filters': {
+            'state': {'where': "abbrev = 'MN'"},
+            'city': {'where': "state_abbrev = 'MN'"},
+            'landmark': {'where': "city = 'Duluth'"},
+        }
+    }
+    (src, dest) = results(*sqlite_data, args_with_filter)
+    assert src.tables[(None, 'city')].n_rows == 1
+    dest_curs = dest.conn.connection.cursor()
+    cities = dest_curs.execute("SELECT name FROM city").fetchall()
+    assert cities == [('Duluth', )]
+
+
+def test_ordered_sample(sqlite_data):
+    args_with_order = DummyArgs()
+    args_with_order.tables = ['state']
+    args_with_order.config = {'filters': {'state': {'order_by': 'abbrev DESC'}}}
+    (src, dest) = results(*sqlite_data, args_with_order)
+    dest_curs = dest.conn.connection.cursor()
+    states = dest_curs.execute("SELECT abbrev FROM state").fetchall()
+    assert states == [('OH', )]
+
+
+def test_queues_hold_deduplicated_keys():
+    (source_filename, source_db) = temp_sqlite_db()
+    (dest_filename, dest_db) = temp_sqlite_db()
+    for db in (source_db, dest_db):
+        db.execute("CREATE TABLE author (id INTEGER PRIMARY KEY, name)")
+        db.execute("""CREATE TABLE book (id INTEGER PRIMARY KEY, author_id,
+                      FOREIGN KEY (author_id) REFERENCES author(id))""")
+        db.execute("CREATE INDEX book_author ON book (author_id)")
+    source_db.execute("INSERT INTO author VALUES (1, 'Austen')")
+    for book_id in range(10):
+        source_db.execute("INSERT INTO book VALUES (?, 1)", (book_id, ))
+    source_db.commit()
+    args_with_cap = DummyArgs()
+    args_with_cap.max_queue = 4
+    src = Db(sqla_url(source_filename), args_with_cap)
+    dest = Db(sqla_url(dest_filename), args_with_cap)
+    src.assign_target(dest)
+    (author, book) = (src.tables[(None, 'author')], src.tables[(None, 'book')])
+    row = src.conn.execute(author.select()).first()
+    src.create_row_in(row, dest, author.target)
+    src.create_row_in(row, dest, author.target, prioritized=True)
+    assert not book.target.requested  # moved to required, once each
+    assert list(book.target.required) == [(book_id, )
+                                          for book_id in range(10)]
+    assert set(book.target.required.values()) == set([None])  # keys only
+    (next_book, prioritized) = book.next_row()
+    assert (next_book['id'], next_book['author_id'], prioritized) == (0, 1,
+                                                                      True)
+    assert len(book.target.fetched_required) == 9
+
+    src.assign_target(dest)
+    src.create_row_in(row, dest, author.target)
+    assert len(book.target.requested) == 4
+    os.unlink(source_filename)
+    os.unlink(dest_filename)
+
+
+def test_nested_queues_skip_rows_already_fetched_or_created():
+    filenames = []
+    dbs = []
+    for _ in range(3):
+        (filename, db) = temp_sqlite_db()
+        db.execute("CREATE TABLE author (id INTEGER PRIMARY KEY, name)")
+        db.execute("""CREATE TABLE book (id INTEGER PRIMARY KEY, author_id,
+                      FOREIGN KEY (author_id) REFERENCES author(id))""")
+        db.execute("CREATE INDEX book_author ON book (author_id)")
+        db.commit()
+        filenames.append(filename)
+        dbs.append(db)
+    dbs[0].execute("INSERT INTO author VALUES (1, 'Austen')")
+    for book_id in range(10):
+        dbs[0].execute("INSERT INTO book VALUES (?, 1)", (book_id, ))
+    dbs[0].commit()
+    args_with_nested = DummyArgs()
+    args_with_nested.fraction = 1.0
+    (src, dest, nested) = [
+        Db(sqla_url(filename), args_with_nested) for filename in filenames
+    ]
+    src.assign_target(dest)
+    src.assign_nested_targets([(nested, 0.5)])
+    (author, book) = (src.tables[(None, 'author')], src.tables[(None, 'book')])
+    src.create_row_in(src.conn.execute(author.select()).first(), dest,
+                      author.target)
+    assert len(book.target.requested) == 10
+    src.create_row_in(book.next_row()[0], dest, book.target)
+    for book_id in range(10):  # fetched, if not yet created
+        src.request(book, {'id': book_id}, False)
+    assert not book.target.requested
+    while book.target.fetched_requested:
+        src.create_row_in(book.next_row()[0], dest, book.target)
+    for book_id in range(10):  # created, in their own nested levels
+        src.request(book, {'id': book_id}, False)
+    assert not book.target.requested
+    [drawn] = [
+        book_id for book_id in range(10)
+        if src.nested_level(book, (book_id, ))
+    ][:1]
+    book.target.levels[(drawn, )] = 0  # as if only a parent's level
+    src.request(book, {'id': drawn}, False)
+    assert list(book.target.requested) == [(drawn, )]
+    for filename in filenames:
+        os.unlink(filename)
+
+
+def test_library_subsets_reuse_reflection(sqlite_data):
+    (source_url, dest_url) = sqlite_data
+    engine = sa.create_engine(source_url)
+    listeners = len(engine.pool.dispatch.connect)
+    with pytest.raises(TypeError):
+        Subsetter(engine)  # no default fraction
+    with pytest.raises(TypeError):
+        Subsetter(engine, 0.25, dest=dest_url)
+    library = Subsetter(engine, 0.25, children=25, exclude_tables=['zeppos'])
+    stats = library.subset(dest_url)
+    dest = sa.create_engine(dest_url)
+    assert stats['tables']['city'] == dest.execute(
+        "SELECT count(*) FROM city").scalar() >= 1
+    assert stats['rows'] == sum(stats['tables'].values())
+    assert 'zeppos' not in stats['tables']
+    source = library.databases[engine]
+    reflected = source.tables[(None, 'city')]
+
+    (other_filename, other_db) = temp_sqlite_db()
+    for table_def in TABLE_DEFINITIONS:
+        other_db.execute(table_def)
+    other_db.commit()
+    conn = sa.create_engine(sqla_url(other_filename)).connect()
+    transaction = conn.begin()
+    stats = library.subset(conn, fraction=0.5, children=0, seed=7)
+    assert library.databases[engine] is source
+    assert source.tables[(None, 'city')] is reflected
+    assert stats['tables']['state'] == conn.execute(
+        "SELECT count(*) FROM state").scalar() >= 2
+    transaction.rollback()  # the subset was written in the caller's
+    assert conn.execute("SELECT count(*) FROM state").scalar() == 0
+    with pytest.raises(TypeError):
+        library.subset(dest_url, tables=['city'])
+    # the caller's engine is left without listeners of ours
+    assert len(engine.pool.dispatch.connect) == listeners
+    conn.close()
+    library.close()
+    os.unlink(other_filename)
+
+
+def test_library_reuses_reflection_across_connections(
+        sqlite_data, monkeypatch):
+    (source_url, dest_url) = sqlite_data
+    reflected = []
+    db_init = Db.__init__
+
+    def count_reflections(self, sqla_conn, *args, **kwargs):
+        reflected.append(sqla_conn)
+        db_init(self, sqla_conn, *args, **kwargs)
+
+    monkeypatch.setattr(Db, '__init__', count_reflections)
+    library = Subsetter(source_url, 0.5)
+    dest = sa.create_engine(dest_url)
+    for _ in range(3):
+        conn = dest.connect()
+        transaction = conn.begin()
+        stats = library.subset(conn)
+        assert stats['tables']['state'] == conn.execute(
+            "SELECT count(*) FROM state").scalar() >= 1
+        transaction.rollback()
+        conn.close()
+    assert len(reflected) == 2  # the source and the destination, once each
+    assert len(library.databases) == 2
+    library.close()
+
+
+def test_build_tables_from_catalog():
+    def column(name, col_type, nullable=True):
+        return {
+            'name': name,
+            'type': col_type,
+            'default': None,
+            'nullable': nullable,
+            'autoincrement': False,
+        }
+
+    mood = ENUM('happy', 'sad', name='mood')
+    catalog = {
+        (None, 'owner'): {
+            'columns': [column('id', sa.Integer(), nullable=False)],
+            'pk': ['id'],
+            'fks': [],
+        },
+        (None, 'cat'): {
+            'columns': [
+                column('id', sa.Integer(), nullable=False),
+                column('owner_id', sa.Integer()),
+                column('moods', ARRAY(mood)),
+            ],
+            'pk': ['id'],
+            'fks': [{
+                'name': 'cat_owner',
+                'constrained_columns': ['owner_id'],
+                'referred_schema': None,
+                'referred_table': 'owner',
+                'referred_columns': ['id'],
+            }],
+        },
+        ('other', 'stray'): {
+            'columns': [column('id', sa.Integer())],
+            'pk': [],
+            'fks': [],
+        },
+    }
+    meta = sa.MetaData()
+    tables = build_tables(meta, catalog, None)
+    assert sorted(tables) == [(None, 'cat'), (None, 'owner')]
+    cat = meta.tables['cat']
+    assert [col.name for col in cat.primary_key.columns] == ['id']
+    assert type(cat.c.moods.type).__name__ == 'ArrayOfEnum'
+    [fk] = cat.foreign_keys
+    assert fk.column is meta.tables['owner'].c.id
+    assert [tbl.name for tbl in meta.sorted_tables] == ['owner', 'cat']